@@ -87,9 +87,9 @@ class PPTCrew_wo_Decoupling(PPTCrew):
             images_info=image_info,
         )
         for error_idx in range(self.retry_times):
-            edited_slide: SlidePage = deepcopy(
-                self.presentation.slides[template["template_id"] - 1]
-            )
+            edited_slide: SlidePage = self.presentation.slides[
+                template["template_id"] - 1
+            ].clone()
             feedback = code_executor.execute_actions(edit_actions, edited_slide)
             if feedback is None:
                 return edited_slide
@@ -98,7 +98,7 @@ class PPTCrew_wo_Decoupling(PPTCrew):
                     f"Failed to generate slide, tried too many times at editing\ntraceback: {feedback[1]}"
                 )
             edit_actions = self.staffs["agent"].retry(*feedback, error_idx + 1)
-        self.empty_prs.build_slide(edited_slide)
+        self._build_slide(edited_slide)
         return edited_slide
 
 
@@ -137,9 +137,9 @@ class PPTCrew_wo_SchemaInduction(PPTCrew):
             command_list="\n".join([str(i) for i in command_list]),
         )
         for error_idx in range(self.retry_times):
-            edited_slide: SlidePage = deepcopy(
-                self.presentation.slides[template["template_id"] - 1]
-            )
+            edited_slide: SlidePage = self.presentation.slides[
+                template["template_id"] - 1
+            ].clone()
             feedback = code_executor.execute_actions(edit_actions, edited_slide)
             if feedback is None:
                 break
@@ -148,7 +148,7 @@ class PPTCrew_wo_SchemaInduction(PPTCrew):
                     f"Failed to generate slide, tried too many times at editing\ntraceback: {feedback[1]}"
                 )
             edit_actions = self.staffs["coder"].retry(*feedback, error_idx + 1)
-        self.empty_prs.build_slide(edited_slide)
+        self._build_slide(edited_slide)
         return edited_slide
 
 
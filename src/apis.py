@@ -1,11 +1,12 @@
+import ast
 import inspect
 import os
 import re
 import traceback
-from copy import deepcopy
-from dataclasses import dataclass
+from copy import copy
+from dataclasses import dataclass, field
 from enum import Enum
-from functools import partial
+from functools import lru_cache, partial
 
 import PIL
 from pptx.enum.text import MSO_ANCHOR, PP_ALIGN
@@ -27,6 +28,67 @@ class HistoryMark:
     CODE_RUN_CORRECT = "code_run_correct"
 
 
+FUNCTION_REGEX = re.compile(r"^[a-z]+_[a-z_]+\(.+\)")
+
+
+@dataclass(frozen=True)
+class ActionStep:
+    line: str
+    func: str = None
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    error: tuple[type, str] = None
+
+    def validate(self):
+        if self.error is not None:
+            raise self.error[0](self.error[1])
+
+
+def compile_line(line: str, registered_functions: dict[str, callable]) -> ActionStep:
+    if line.startswith("def"):
+        return ActionStep(
+            line, error=(PermissionError, "The function definition were not allowed.")
+        )
+    if line.startswith("#") or not FUNCTION_REGEX.match(line):
+        return ActionStep(line)
+    func = line.split("(")[0]
+    if func not in registered_functions:
+        return ActionStep(
+            line, func, error=(NameError, f"The function {func} is not defined.")
+        )
+    try:
+        call = ast.parse(line, mode="eval").body
+    except Exception as e:
+        return ActionStep(line, func, error=(SyntaxError, str(e)))
+    if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name):
+        return ActionStep(
+            line, func, error=(ValueError, "Each line must be a single api call.")
+        )
+    try:
+        args = tuple(ast.literal_eval(arg) for arg in call.args)
+        kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in call.keywords}
+    except Exception:
+        # e.g. ValueError for names, TypeError for unhashable set or dict members
+        return ActionStep(
+            line,
+            func,
+            error=(ValueError, f"The arguments of {func} must be literal values."),
+        )
+    if None in kwargs:
+        return ActionStep(
+            line, func, error=(ValueError, "Unpacking arguments is not allowed.")
+        )
+    return ActionStep(line, func, args, kwargs)
+
+
+@lru_cache(maxsize=4096)
+def compile_actions(actions: str) -> tuple[ActionStep, ...]:
+    registered_functions = API_TYPES.all_funcs()
+    return tuple(
+        compile_line(line, registered_functions) for line in actions.split("\n")
+    )
+
+
 class CodeExecutor:
 
     def __init__(self, retry_times: int):
@@ -35,7 +97,11 @@ class CodeExecutor:
         self.code_history = []
         self.retry_times = retry_times
         self.registered_functions = API_TYPES.all_funcs()
-        self.function_regex = re.compile(r"^[a-z]+_[a-z_]+\(.+\)")
+
+    def merge(self, code_executor: "CodeExecutor"):
+        self.api_history.extend(code_executor.api_history)
+        self.command_history.extend(code_executor.command_history)
+        self.code_history.extend(code_executor.code_history)
 
     def get_apis_docs(self, funcs: list[callable], show_example: bool = True):
         api_doc = []
@@ -68,28 +134,30 @@ class CodeExecutor:
         self.api_history.append(
             [HistoryMark.API_CALL_ERROR, edit_slide.slide_idx, actions]
         )
-        for line_idx, line in enumerate(api_calls):
-            try:
-                if line_idx == len(api_calls) - 1 and not found_code:
-                    raise ValueError(
-                        "No code block found in the output, please output the api calls without any prefix."
-                    )
-                if line.startswith("def"):
-                    raise PermissionError("The function definition were not allowed.")
-                if line.startswith("#"):
+        line_idx = 0
+        try:
+            plan = compile_actions(actions.strip())
+            # the whole block is validated before touching the slide
+            for line_idx, step in enumerate(plan):
+                step.validate()
+            line_idx = len(plan) - 1
+            if not found_code and all(step.func is None for step in plan[:-1]):
+                raise ValueError(
+                    "No code block found in the output, please output the api calls without any prefix."
+                )
+            for line_idx, step in enumerate(plan):
+                if step.line.startswith("#"):
                     if len(self.command_history) != 0:
                         self.command_history[-1][0] = HistoryMark.COMMENT_CORRECT
-                    self.command_history.append([HistoryMark.COMMENT_ERROR, line, None])
+                    self.command_history.append(
+                        [HistoryMark.COMMENT_ERROR, step.line, None]
+                    )
                     continue
-                if not self.function_regex.match(line):
+                if step.func is None:
                     continue
-                found_code = True
-                func = line.split("(")[0]
-                if func not in self.registered_functions:
-                    raise NameError(f"The function {func} is not defined.")
                 # only one of clone and del can be used in a row
-                if func.startswith("clone") or func.startswith("del"):
-                    tag = func.split("_")[0]
+                if step.func.startswith("clone") or step.func.startswith("del"):
+                    tag = step.func.split("_")[0]
                     if (
                         self.command_history[-1][-1] == None
                         or self.command_history[-1][-1] == tag
@@ -100,20 +168,21 @@ class CodeExecutor:
                             "Invalid command: Both 'clone_paragraph' and 'del_paragraph'/'del_image' are used within a single command. "
                             "Each command must only perform one of these operations based on the quantity_change."
                         )
-                self.code_history.append([HistoryMark.CODE_RUN_ERROR, line, None])
-                partial_func = partial(self.registered_functions[func], edit_slide)
-                eval(line, {}, {func: partial_func})
-                self.code_history[-1][0] = HistoryMark.CODE_RUN_CORRECT
-            except:
-                trace_msg = traceback.format_exc()
-                if len(self.code_history) != 0:
-                    self.code_history[-1][-1] = trace_msg
-                api_lines = (
-                    "\n".join(api_calls[: line_idx - 1])
-                    + f"\n--> Error Line: {line}\n"
-                    + "\n".join(api_calls[line_idx + 1 :])
+                self.code_history.append([HistoryMark.CODE_RUN_ERROR, step.line, None])
+                self.registered_functions[step.func](
+                    edit_slide, *step.args, **step.kwargs
                 )
-                return api_lines, trace_msg
+                self.code_history[-1][0] = HistoryMark.CODE_RUN_CORRECT
+        except:
+            trace_msg = traceback.format_exc()
+            if len(self.code_history) != 0:
+                self.code_history[-1][-1] = trace_msg
+            api_lines = (
+                "\n".join(api_calls[: line_idx - 1])
+                + f"\n--> Error Line: {api_calls[line_idx]}\n"
+                + "\n".join(api_calls[line_idx + 1 :])
+            )
+            return api_lines, trace_msg
         if len(self.command_history) != 0:
             self.command_history[-1][0] = HistoryMark.COMMENT_CORRECT
         self.api_history[-1][0] = HistoryMark.API_CALL_CORRECT
@@ -121,9 +190,9 @@ class CodeExecutor:
 
 # supporting functions
 def element_index(slide: SlidePage, element_id: int):
-    for shape in slide:
-        if shape.shape_idx == element_id:
-            return shape
+    shape = slide.get_shape(element_id)
+    if shape is not None:
+        return shape
     raise IndexError(f"Cannot find element {element_id}, is it deleted or not exist?")
 
 
@@ -148,13 +217,13 @@ def del_paragraph(slide: SlidePage, div_id: int, paragraph_id: int):
     assert (
         shape.text_frame.is_textframe
     ), "The element does not have a text frame, please check the element id and type of element."
-    for para in shape.text_frame.paragraphs:
-        if para.idx == paragraph_id:
-            shape.text_frame.paragraphs.remove(para)
-            shape._closures["delete"].append(
-                Closure(partial(del_para, para.real_idx), para.real_idx)
-            )
-            return
+    para = shape.text_frame.get_paragraph(paragraph_id)
+    if para is not None:
+        shape.text_frame.remove_paragraph(para)
+        shape.invalidate()
+        shape._closures["delete"].append(
+            Closure(partial(del_para, para.real_idx), para.real_idx)
+        )
     else:
         raise IndexError(
             f"Cannot find the paragraph {paragraph_id} of the element {div_id},"
@@ -165,7 +234,7 @@ def del_paragraph(slide: SlidePage, div_id: int, paragraph_id: int):
 def del_image(slide: SlidePage, figure_id: int):
     shape = element_index(slide, figure_id)
     assert isinstance(shape, Picture), "The element is not a Picture."
-    slide.shapes.remove(shape)
+    slide.remove_shape(shape)
 
 
 def replace_paragraph(slide: SlidePage, div_id: int, paragraph_id: int, text: str):
@@ -173,16 +242,16 @@ def replace_paragraph(slide: SlidePage, div_id: int, paragraph_id: int, text: st
     assert (
         shape.text_frame.is_textframe
     ), "The element does not have a text frame, please check the element id and type of element."
-    for para in shape.text_frame.paragraphs:
-        if para.idx == paragraph_id:
-            para.text = text
-            shape._closures["replace"].append(
-                Closure(
-                    partial(replace_para, para.real_idx, text),
-                    para.real_idx,
-                )
+    para = shape.text_frame.get_paragraph(paragraph_id)
+    if para is not None:
+        para.text = text
+        shape.invalidate()
+        shape._closures["replace"].append(
+            Closure(
+                partial(replace_para, para.real_idx, text),
+                para.real_idx,
             )
-            return
+        )
     else:
         raise IndexError(
             f"Cannot find the paragraph {paragraph_id} of the element {div_id},"
@@ -214,22 +283,22 @@ def clone_paragraph(slide: SlidePage, div_id: int, paragraph_id: int):
     assert (
         shape.text_frame.is_textframe
     ), "The element does not have a text frame, please check the element id and type of element."
+    para = shape.text_frame.get_paragraph(paragraph_id)
+    if para is None:
+        raise IndexError(
+            f"Cannot find the paragraph {paragraph_id} of the element {div_id}, may refer to a non-existed paragraph."
+        )
     max_idx = max([para.idx for para in shape.text_frame.paragraphs])
-    for para in shape.text_frame.paragraphs:
-        if para.idx != paragraph_id:
-            continue
-        shape.text_frame.paragraphs.append(deepcopy(para))
-        shape.text_frame.paragraphs[-1].idx = max_idx + 1
-        shape.text_frame.paragraphs[-1].real_idx = len(shape.text_frame.paragraphs) - 1
-        shape._closures["clone"].append(
-            Closure(
-                partial(clone_para, para.real_idx),
-                para.real_idx,
-            )
+    cloned_para = copy(para)
+    cloned_para.idx = max_idx + 1
+    cloned_para.real_idx = len(shape.text_frame.paragraphs)
+    shape.text_frame.append_paragraph(cloned_para)
+    shape.invalidate()
+    shape._closures["clone"].append(
+        Closure(
+            partial(clone_para, para.real_idx),
+            para.real_idx,
         )
-        return
-    raise IndexError(
-        f"Cannot find the paragraph {paragraph_id} of the element {div_id}, may refer to a non-existed paragraph."
     )
 
 
@@ -4,12 +4,13 @@ import importlib
 import itertools
 import json
 import os
+import shutil
+import sqlite3
 import sys
-import time
+import tempfile
 import traceback
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
+from collections import OrderedDict
 from datetime import datetime
 from typing import Dict, List
 
@@ -28,17 +29,30 @@ from fastapi import (
 from fastapi.logger import logger
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from FlagEmbedding import BGEM3FlagModel
 from jinja2 import Template
-from marker.models import create_model_dict
 
 import induct
 import llms
 import pptgen
-from model_utils import get_image_model, parse_pdf
-from multimodal import ImageLabler
+from model_utils import EmbeddingCache, model_registry, parse_pdf, set_embedding_cache
+from multimodal import (
+    CaptionStore,
+    ImageLabler,
+    caption_concurrently,
+    set_caption_store,
+)
 from presentation import Presentation
-from utils import Config, is_image_path, pjoin, ppt_to_images, tenacity
+from task_queue import TaskQueue, TaskWorkerPool
+from utils import (
+    Config,
+    file_lock,
+    is_image_path,
+    pjoin,
+    ppt_to_images,
+    save_json,
+    start_render_pool,
+    tenacity,
+)
 
 # constants
 DEBUG = True if len(sys.argv) == 1 else False
@@ -52,19 +66,21 @@ STAGES = [
 ]
 NUM_MODELS = 1 if len(sys.argv) == 1 else int(sys.argv[1])
 NUM_INSTANCES_PER_MODEL = 4
+MAX_QUEUED_TASKS = NUM_MODELS * NUM_INSTANCES_PER_MODEL * 4
+MAX_INFLIGHT_PER_ROLE = 4
+NUM_RENDER_WORKERS = 2
 DEVICE_COUNT = torch.cuda.device_count()
+MODEL_IDLE_TIMEOUT = 3600
+UPLOAD_CHUNK_SIZE = 1 << 20
+PROGRESS_POLL_INTERVAL = 1
+# identical requests within this many seconds reuse the same task, 0 disables it
+RESULT_CACHE_TTL = 24 * 3600
 REFINE_TEMPLATE = Template(open("prompts/document_refine.txt").read())
 
-# models
-text_models = [
-    BGEM3FlagModel("BAAI/bge-m3", use_fp16=True, device=i % DEVICE_COUNT)
-    for i in range(NUM_MODELS)
-]
-image_models = [get_image_model(device=i % DEVICE_COUNT) for i in range(NUM_MODELS)]
-marker_models = [
-    create_model_dict(device=i % DEVICE_COUNT, dtype=torch.float16)
-    for i in range(NUM_MODELS)
-]
+# models are loaded on first use, model_idx of a task picks the device
+model_registry.idle_timeout = MODEL_IDLE_TIMEOUT
+set_embedding_cache(EmbeddingCache(cache_dir=pjoin(RUNS_DIR, "embedding_cache")))
+set_caption_store(CaptionStore(pjoin(RUNS_DIR, "caption_cache")))
 
 # server
 app = FastAPI()
@@ -75,10 +91,80 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-progress_store: Dict[str, Dict] = {}
-active_connections: Dict[str, WebSocket] = {}
 counter = itertools.cycle(range(NUM_MODELS))
-executor = ThreadPoolExecutor(max_workers=NUM_MODELS * NUM_INSTANCES_PER_MODEL)
+task_queue = TaskQueue(pjoin(RUNS_DIR, "tasks.db"))
+
+
+class ProgressBus:
+    def __init__(self, store: TaskQueue = None, max_tasks: int = 1024):
+        self.loop: asyncio.AbstractEventLoop = None
+        self.store = store
+        self.max_tasks = max_tasks
+        self.subscribers: Dict[str, set[asyncio.Queue]] = {}
+        self.last_messages: OrderedDict[str, dict] = OrderedDict()
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        # must be called on the server loop, replays the latest message
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(task_id, set()).add(queue)
+        if task_id in self.last_messages:
+            queue.put_nowait(self.last_messages[task_id])
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(task_id, set())
+        queues.discard(queue)
+        if len(queues) == 0:
+            self.subscribers.pop(task_id, None)
+
+    def publish(self, task_id: str, status: str, progress: int):
+        # thread-safe, hands the message over to the server loop
+        message = {"progress": progress, "status": status}
+        if self.store is not None:
+            # best effort, websockets served by other processes poll it
+            try:
+                self.store.set_progress(task_id, message)
+            except sqlite3.Error as e:
+                print(f"failed to store progress of {task_id}: {e}")
+        if self.loop is None or self.loop.is_closed():
+            print(
+                f"no server loop, task: {task_id}, status: {status}, progress: {progress}"
+            )
+            return
+        self.loop.call_soon_threadsafe(self._dispatch, task_id, message)
+
+    def _dispatch(self, task_id: str, message: dict):
+        self.last_messages[task_id] = message
+        self.last_messages.move_to_end(task_id)
+        while len(self.last_messages) > self.max_tasks:
+            self.last_messages.popitem(last=False)
+        for queue in self.subscribers.get(task_id, ()):
+            queue.put_nowait(message)
+
+
+progress_bus = ProgressBus(task_queue)
+
+
+@app.on_event("startup")
+async def bind_progress_bus():
+    progress_bus.bind(asyncio.get_running_loop())
+
+
+@app.on_event("startup")
+def start_workers():
+    app.state.worker_pool = TaskWorkerPool(
+        task_queue, run_task, NUM_MODELS * NUM_INSTANCES_PER_MODEL
+    )
+    app.state.worker_pool.start()
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    app.state.worker_pool.stop()
+    llms.llm_loop.close()
 
 
 class ProgressManager:
@@ -86,14 +172,11 @@ class ProgressManager:
         self.task_id = task_id
         self.stages = stages
         self.debug = debug
-        self.socket = active_connections.get(task_id)
         self.failed = False
         self.current_stage = 0
         self.total_stages = len(stages)
 
     def run_stage(self, func, *args, **kwargs):
-        if self.task_id not in active_connections:
-            self.failed = True
         if self.failed:
             return
         try:
@@ -106,24 +189,30 @@ class ProgressManager:
     def report_progress(self):
         self.current_stage += 1
         progress = int((self.current_stage / self.total_stages) * 100)
-        asyncio.run(
-            send_progress(
-                self.socket,
-                f"Stage: {self.stages[self.current_stage - 1]}",
-                progress,
-            )
+        progress_bus.publish(
+            self.task_id, f"Stage: {self.stages[self.current_stage - 1]}", progress
+        )
+
+    def report_substage(self, num_finished: int, total: int):
+        # moves from the current stage towards the next one
+        progress = int(
+            (self.current_stage + num_finished / max(total, 1))
+            / self.total_stages
+            * 100
+        )
+        progress_bus.publish(
+            self.task_id,
+            f"Stage: {self.stages[self.current_stage - 1]} ({num_finished}/{total})",
+            min(progress, 100),
         )
 
     def fail_stage(self, error_message: str):
-        asyncio.run(
-            send_progress(
-                self.socket,
-                f"{self.stages[self.current_stage]} Error: {error_message}",
-                100,
-            )
+        progress_bus.publish(
+            self.task_id,
+            f"{self.stages[self.current_stage]} Error: {error_message}",
+            100,
         )
         self.failed = True
-        active_connections.pop(self.task_id, None)
         if self.debug:
             logger.error(
                 f"{self.task_id}: {self.stages[self.current_stage]} Error: {error_message}"
@@ -138,6 +227,13 @@ async def create_task(
     numberOfPages: int = Form(...),
     selectedModel: str = Form(...),
 ):
+    # sqlite may wait on the write lock held by workers, so it stays off the loop
+    depth = await asyncio.to_thread(task_queue.depth)
+    if depth["queued"] >= MAX_QUEUED_TASKS:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many queued tasks, limit is {MAX_QUEUED_TASKS}",
+        )
     if DEBUG:
         importlib.reload(induct)
         importlib.reload(llms)
@@ -152,51 +248,100 @@ async def create_task(
         "model": selectedModel,
     }
     if pptxFile is not None:
-        pptx_blob = await pptxFile.read()
-        pptx_md5 = hashlib.md5(pptx_blob).hexdigest()
-        task["pptx"] = pptx_md5
-        pptx_dir = pjoin(RUNS_DIR, "pptx", pptx_md5)
-        if not os.path.exists(pptx_dir):
-            os.makedirs(pptx_dir, exist_ok=True)
-            with open(pjoin(pptx_dir, "source.pptx"), "wb") as f:
-                f.write(pptx_blob)
+        task["pptx"] = await save_upload(pptxFile, "pptx", "source.pptx")
     if pdfFile is not None:
-        pdf_blob = await pdfFile.read()
-        pdf_md5 = hashlib.md5(pdf_blob).hexdigest()
-        task["pdf"] = pdf_md5
-        pdf_dir = pjoin(RUNS_DIR, "pdf", pdf_md5)
-        if not os.path.exists(pdf_dir):
-            os.makedirs(pdf_dir, exist_ok=True)
-            with open(pjoin(pdf_dir, "source.pdf"), "wb") as f:
-                f.write(pdf_blob)
+        task["pdf"] = await save_upload(pdfFile, "pdf", "source.pdf")
     if topic is not None:
         task["pdf"] = topic
-    progress_store[task_id] = task
-    executor.submit(ppt_gen, task_id)
+    fingerprint = request_fingerprint(task)
+    if RESULT_CACHE_TTL > 0:
+        cached = await asyncio.to_thread(task_queue.find, fingerprint, RESULT_CACHE_TTL)
+        if cached is not None and (
+            cached[1] != "done"
+            or os.path.exists(pjoin(RUNS_DIR, cached[0], "final.pptx"))
+        ):
+            os.rmdir(pjoin(RUNS_DIR, task_id))
+            logger.info(f"task {task_id} served by {cached[0]} ({cached[1]})")
+            return {"task_id": cached[0].replace("/", "|")}
+    await asyncio.to_thread(task_queue.submit, task_id, task, fingerprint)
     return {"task_id": task_id.replace("/", "|")}
 
 
-async def send_progress(websocket: WebSocket, status: str, progress: int):
-    if websocket is None:
-        print(f"websocket is None, status: {status}, progress: {progress}")
+def request_fingerprint(task: dict) -> str:
+    # model_idx only picks the device, it does not change the result
+    key = [task["pptx"], task.get("pdf"), task["numberOfPages"], task["model"]]
+    return hashlib.md5(json.dumps(key).encode()).hexdigest()
+
+
+async def save_upload(upload: UploadFile, kind: str, filename: str) -> str:
+    # hashed while written aside, then renamed into the content addressed folder
+    os.makedirs(pjoin(RUNS_DIR, kind), exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=".upload-", dir=pjoin(RUNS_DIR, kind))
+    try:
+        hash_md5 = hashlib.md5()
+        with open(pjoin(temp_dir, filename), "wb") as f:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                hash_md5.update(chunk)
+                f.write(chunk)
+        file_md5 = hash_md5.hexdigest()
+        target_dir = pjoin(RUNS_DIR, kind, file_md5)
+        if not os.path.exists(target_dir):
+            try:
+                os.rename(temp_dir, target_dir)
+            except OSError:
+                # the same file was uploaded concurrently and renamed first
+                if not os.path.exists(target_dir):
+                    raise
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return file_md5
+
+
+async def forward_progress(websocket: WebSocket, task_id: str, queue: asyncio.Queue):
+    # the bus delivers tasks run by this process, the others are polled from the queue
+    last_message = None
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), PROGRESS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                message = await asyncio.to_thread(task_queue.get_progress, task_id)
+            if message is None or message == last_message:
+                continue
+            await websocket.send_json(message)
+            last_message = message
+    except Exception:
         return
-    await websocket.send_json({"progress": progress, "status": status})
 
 
 @app.websocket("/ws/{task_id}")
 async def websocket_endpoint(websocket: WebSocket, task_id: str):
     task_id = task_id.replace("|", "/")
-    if task_id in progress_store:
-        await websocket.accept()
-    else:
+    status = await asyncio.to_thread(task_queue.status, task_id)
+    if status is None:
         raise HTTPException(status_code=404, detail="Task not found")
-    active_connections[task_id] = websocket
+    await websocket.accept()
+    if status in ["done", "failed"]:
+        # finished earlier, e.g. an identical request served from the result cache
+        message = {"progress": 100, "status": f"Stage: {STAGES[-1]}"}
+        if status == "failed":
+            message = await asyncio.to_thread(task_queue.get_progress, task_id) or {
+                "progress": 100,
+                "status": "Task failed",
+            }
+        await websocket.send_json(message)
+        await websocket.close()
+        return
+    queue = progress_bus.subscribe(task_id)
+    sender = asyncio.create_task(forward_progress(websocket, task_id, queue))
     try:
         while True:
             data = await websocket.receive_text()
     except WebSocketDisconnect:
         logger.info("websocket disconnected", task_id)
-        active_connections.pop(task_id, None)
+    finally:
+        sender.cancel()
+        progress_bus.unsubscribe(task_id, queue)
 
 
 @tenacity
@@ -267,30 +412,35 @@ async def feedback(request: Request):
     return {"message": "Feedback submitted successfully"}
 
 
+@app.get("/api/queue")
+def queue_depth():
+    return task_queue.depth() | {"limit": MAX_QUEUED_TASKS}
+
+
 @app.get("/")
 def hello():
-    if len(active_connections) < NUM_MODELS * NUM_INSTANCES_PER_MODEL:
+    if task_queue.depth()["queued"] < MAX_QUEUED_TASKS:
         return {"message": "Hello, World!"}
     else:
         raise HTTPException(
             status_code=429,
-            detail=f"Too many running connections, limit is {NUM_MODELS}",
+            detail=f"Too many queued tasks, limit is {MAX_QUEUED_TASKS}",
         )
 
 
-def ppt_gen(task_id: str, rerun=False):
-    if rerun:
+def run_task(task_id: str, task: dict, attempts: int):
+    # tasks run detached from their websocket, which may live in another process,
+    # a resumed task skips finished stages through their cached outputs
+    if attempts > 1:
+        logger.info(f"resuming {task_id}, attempt {attempts}")
+    if not ppt_gen(task_id, task):
+        raise RuntimeError(f"task {task_id} failed")
+
+
+def ppt_gen(task_id: str, task: dict = None):
+    if task is None:
         task_id = task_id.replace("|", "/")
-        active_connections[task_id] = None
-        progress_store[task_id] = json.load(open(pjoin(RUNS_DIR, task_id, "task.json")))
-    for _ in range(100):
-        if task_id in active_connections:
-            break
-        time.sleep(0.02)
-    else:
-        progress_store.pop(task_id)
-        return
-    task = progress_store.pop(task_id)
+        task = json.load(open(pjoin(RUNS_DIR, task_id, "task.json")))
     pptx_md5 = task["pptx"]
     pdf_md5 = task["pdf"]
     generation_config = Config(pjoin(RUNS_DIR, task_id))
@@ -299,136 +449,146 @@ def ppt_gen(task_id: str, rerun=False):
 
     if len(pdf_md5) != 32:
         pdf_dir = pjoin(RUNS_DIR, "pdf", pdf_md5)
-        if not os.path.exists(pdf_dir + "/refined_doc.json"):
-            os.makedirs(pdf_dir, exist_ok=True)
-            json.dump(
-                topic_generate(task["pdf"]),
-                open(pjoin(pdf_dir, "refined_doc.json"), "w"),
-            )
+        with file_lock(pjoin(pdf_dir, ".lock")):
+            if not os.path.exists(pdf_dir + "/refined_doc.json"):
+                os.makedirs(pdf_dir, exist_ok=True)
+                json.dump(
+                    topic_generate(task["pdf"]),
+                    open(pjoin(pdf_dir, "refined_doc.json"), "w"),
+                )
 
-    model_idx = task["model_idx"]
-    text_model, image_model, marker_model = (
-        text_models[model_idx],
-        image_models[model_idx],
-        marker_models[model_idx],
-    )
+    device = task["model_idx"] % DEVICE_COUNT
 
     progress = ProgressManager(task_id, STAGES)
     parsedpdf_dir = pjoin(RUNS_DIR, "pdf", pdf_md5)
     ppt_image_folder = pjoin(pptx_config.RUN_DIR, "slide_images")
 
-    asyncio.run(
-        send_progress(active_connections[task_id], "task initialized successfully", 10)
-    )
+    progress_bus.publish(task_id, "task initialized successfully", 10)
 
     try:
         # ppt parsing
-        presentation = Presentation.from_file(
-            pjoin(pptx_config.RUN_DIR, "source.pptx"), pptx_config
-        )
-        if not os.path.exists(ppt_image_folder) or len(
-            os.listdir(ppt_image_folder)
-        ) != len(presentation):
-            ppt_to_images(pjoin(pptx_config.RUN_DIR, "source.pptx"), ppt_image_folder)
-            assert len(os.listdir(ppt_image_folder)) == len(presentation) + len(
-                presentation.error_history
-            ), "Number of parsed slides and images do not match"
-
-            for err_idx, _ in presentation.error_history:
-                os.remove(pjoin(ppt_image_folder, f"slide_{err_idx:04d}.jpg"))
-            for i, slide in enumerate(presentation.slides, 1):
-                slide.slide_idx = i
-                os.rename(
-                    pjoin(ppt_image_folder, f"slide_{slide.real_idx:04d}.jpg"),
-                    pjoin(ppt_image_folder, f"slide_{slide.slide_idx:04d}.jpg"),
+        with file_lock(pjoin(pptx_config.RUN_DIR, ".lock")):
+            presentation = Presentation.from_file(
+                pjoin(pptx_config.RUN_DIR, "source.pptx"), pptx_config
+            )
+            if not os.path.exists(ppt_image_folder) or len(
+                os.listdir(ppt_image_folder)
+            ) != len(presentation):
+                ppt_to_images(
+                    pjoin(pptx_config.RUN_DIR, "source.pptx"), ppt_image_folder
                 )
-
-        labler = ImageLabler(presentation, pptx_config)
-        progress.run_stage(labler.caption_images)
-
-        # pdf parsing
-        if not os.path.exists(pjoin(parsedpdf_dir, "source.md")) and not os.path.exists(
-            pjoin(parsedpdf_dir, "refined_doc.json")
-        ):
-            text_content = progress.run_stage(
-                parse_pdf,
-                pjoin(RUNS_DIR, "pdf", pdf_md5, "source.pdf"),
-                parsedpdf_dir,
-                marker_model,
+                assert len(os.listdir(ppt_image_folder)) == len(presentation) + len(
+                    presentation.error_history
+                ), "Number of parsed slides and images do not match"
+
+                for err_idx, _ in presentation.error_history:
+                    os.remove(pjoin(ppt_image_folder, f"slide_{err_idx:04d}.jpg"))
+                for i, slide in enumerate(presentation.slides, 1):
+                    slide.slide_idx = i
+                    os.rename(
+                        pjoin(ppt_image_folder, f"slide_{slide.real_idx:04d}.jpg"),
+                        pjoin(ppt_image_folder, f"slide_{slide.slide_idx:04d}.jpg"),
+                    )
+
+            labler = ImageLabler(presentation, pptx_config)
+            progress.run_stage(
+                labler.caption_images, progress_callback=progress.report_substage
             )
-        else:
-            if not os.path.exists(pjoin(parsedpdf_dir, "refined_doc.json")):
-                text_content = open(pjoin(parsedpdf_dir, "source.md")).read()
-            progress.report_progress()
 
-        # doc refine and caption
-        if not os.path.exists(pjoin(parsedpdf_dir, "caption.json")):
-            caption_prompt = open("prompts/caption.txt").read()
+        # pdf parsing
+        with file_lock(pjoin(parsedpdf_dir, ".lock")):
+            if not os.path.exists(
+                pjoin(parsedpdf_dir, "source.md")
+            ) and not os.path.exists(pjoin(parsedpdf_dir, "refined_doc.json")):
+                with model_registry.use("marker", device) as marker_model:
+                    text_content = progress.run_stage(
+                        parse_pdf,
+                        pjoin(RUNS_DIR, "pdf", pdf_md5, "source.pdf"),
+                        parsedpdf_dir,
+                        marker_model,
+                    )
+            else:
+                if not os.path.exists(pjoin(parsedpdf_dir, "refined_doc.json")):
+                    text_content = open(pjoin(parsedpdf_dir, "source.md")).read()
+                progress.report_progress()
+
+            # doc refine and caption, resumes from the captions saved so far
+            caption_file = pjoin(parsedpdf_dir, "caption.json")
             images = {}
-            for k in os.listdir(parsedpdf_dir):
-                if is_image_path(k):
-                    try:
-                        images[pjoin(parsedpdf_dir, k)] = [
-                            llms.vision_model(
-                                caption_prompt, [pjoin(parsedpdf_dir, k)]
-                            ),
-                            PIL.Image.open(pjoin(parsedpdf_dir, k)).size,
-                        ]
-                    except Exception as e:
-                        logger.error(f"Error captioning image {k}: {e}")
-            json.dump(
-                images,
-                open(pjoin(parsedpdf_dir, "caption.json"), "w"),
-                ensure_ascii=False,
-                indent=4,
-            )
-        else:
-            images = json.load(open(pjoin(parsedpdf_dir, "caption.json")))
-        if not os.path.exists(pjoin(parsedpdf_dir, "refined_doc.json")):
-            doc_json = llms.language_model(
-                REFINE_TEMPLATE.render(markdown_document=text_content), return_json=True
-            )
-            json.dump(doc_json, open(pjoin(parsedpdf_dir, "refined_doc.json"), "w"))
-        else:
-            doc_json = json.load(open(pjoin(parsedpdf_dir, "refined_doc.json")))
+            if os.path.exists(caption_file):
+                images = json.load(open(caption_file))
+            pdf_images = [
+                pjoin(parsedpdf_dir, k)
+                for k in os.listdir(parsedpdf_dir)
+                if is_image_path(k) and pjoin(parsedpdf_dir, k) not in images
+            ]
+            captioned = caption_concurrently(pdf_images)
+            for num_finished, (image_path, caption) in enumerate(captioned, 1):
+                if isinstance(caption, Exception):
+                    logger.error(f"Error captioning image {image_path}: {caption}")
+                else:
+                    images[image_path] = [caption, PIL.Image.open(image_path).size]
+                    save_json(images, caption_file)
+                progress.report_substage(num_finished, len(pdf_images))
+            if not os.path.exists(caption_file):
+                save_json(images, caption_file)
+            if not os.path.exists(pjoin(parsedpdf_dir, "refined_doc.json")):
+                doc_json = llms.language_model(
+                    REFINE_TEMPLATE.render(markdown_document=text_content),
+                    return_json=True,
+                )
+                json.dump(doc_json, open(pjoin(parsedpdf_dir, "refined_doc.json"), "w"))
+            else:
+                doc_json = json.load(open(pjoin(parsedpdf_dir, "refined_doc.json")))
 
         progress.report_progress()
 
         # Slide Induction
-        if not os.path.exists(pptx_config.RUN_DIR + "/template_images") or len(
-            os.listdir(pptx_config.RUN_DIR + "/template_images")
-        ) != len(presentation):
-            deepcopy(presentation).save(
-                pjoin(pptx_config.RUN_DIR, "template.pptx"), layout_only=True
-            )
-            ppt_to_images(
-                pjoin(pptx_config.RUN_DIR, "template.pptx"),
+        pptx_lock = file_lock(pjoin(pptx_config.RUN_DIR, ".lock"))
+        with pptx_lock, model_registry.use("image", device) as image_model:
+            if not os.path.exists(pptx_config.RUN_DIR + "/template_images") or len(
+                os.listdir(pptx_config.RUN_DIR + "/template_images")
+            ) != len(presentation):
+                presentation.clone().save(
+                    pjoin(pptx_config.RUN_DIR, "template.pptx"), layout_only=True
+                )
+                ppt_to_images(
+                    pjoin(pptx_config.RUN_DIR, "template.pptx"),
+                    pjoin(pptx_config.RUN_DIR, "template_images"),
+                )
+            slide_inducter = induct.SlideInducter(
+                presentation,
+                ppt_image_folder,
                 pjoin(pptx_config.RUN_DIR, "template_images"),
+                pptx_config,
+                image_model,
             )
-        slide_inducter = induct.SlideInducter(
-            presentation,
-            ppt_image_folder,
-            pjoin(pptx_config.RUN_DIR, "template_images"),
-            pptx_config,
-            image_model,
-        )
-        slide_induction = slide_inducter.content_induct()
+            slide_induction = slide_inducter.content_induct()
 
         # PPT Generation
-        progress.run_stage(
-            pptgen.PPTCrew(text_model, error_exit=False, retry_times=5)
-            .set_examplar(presentation, slide_induction)
-            .generate_pres,
-            generation_config,
-            images,
-            task["numberOfPages"],
-            doc_json,
-        )
+        with model_registry.use("text", device) as text_model:
+            progress.run_stage(
+                pptgen.PPTCrew(
+                    text_model,
+                    error_exit=False,
+                    retry_times=5,
+                    max_inflight=MAX_INFLIGHT_PER_ROLE,
+                )
+                .set_examplar(presentation, slide_induction)
+                .generate_pres,
+                generation_config,
+                images,
+                task["numberOfPages"],
+                doc_json,
+                progress_callback=progress.report_substage,
+            )
         print(task_id, "generation finished")
         progress.report_progress()
+        return not progress.failed
     except Exception as e:
         progress.fail_stage(str(e))
         traceback.print_exc()
+        return False
 
 
 if __name__ == "__main__":
@@ -436,8 +596,9 @@ if __name__ == "__main__":
 
     import uvicorn
 
+    start_render_pool(NUM_RENDER_WORKERS)
     if len(sys.argv) == 1:
-        ppt_gen("2024-12-27|5215990c-9d9e-4f50-b7bc-d8633f072e6b", True)
+        ppt_gen("2024-12-27|5215990c-9d9e-4f50-b7bc-d8633f072e6b")
     ip = (
         subprocess.check_output(
             "hostname -I | tr ' ' '\n' | grep '^124\\.'", shell=True
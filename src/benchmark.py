@@ -0,0 +1,98 @@
+# measure the parsing speed of presentations
+import tempfile
+from glob import glob
+from time import perf_counter
+
+import func_argparse
+from pptx import Presentation as PPTXPre
+from pptx.util import Length
+
+import presentation
+from presentation import Presentation
+from utils import DEFAULT_EXCLUDE, Config, is_primitive, object_to_dict
+
+
+def legacy_object_to_dict(obj, result=None, exclude=None):
+    # object_to_dict before attribute schemas, kept as the baseline
+    if result is None:
+        result = {}
+    exclude = DEFAULT_EXCLUDE.union(exclude or set())
+    for attr in dir(obj):
+        if attr in exclude:
+            continue
+        try:
+            if not attr.startswith("_") and not callable(getattr(obj, attr)):
+                attr_value = getattr(obj, attr)
+                if "real" in dir(attr_value):
+                    attr_value = attr_value.real
+                if attr == "size" and isinstance(attr_value, int):
+                    attr_value = Length(attr_value).pt
+
+                if is_primitive(attr_value):
+                    result[attr] = attr_value
+        except:
+            pass
+    return result
+
+
+def collect_fonts(shapes) -> list:
+    fonts = []
+    for shape in shapes:
+        if hasattr(shape, "shapes"):
+            fonts.extend(collect_fonts(shape.shapes))
+        elif shape.has_text_frame:
+            for paragraph in shape.text_frame.paragraphs:
+                fonts.append(paragraph.font)
+                fonts.extend(run.font for run in paragraph.runs[:1])
+    return fonts
+
+
+def to_dict_speed(pattern: str = "resource/*.pptx", repeat: int = 3):
+    # only the font conversion of parsing, which object_to_dict dominates
+    slide_fonts = [
+        collect_fonts(slide.shapes)
+        for file in sorted(glob(pattern))
+        for slide in PPTXPre(file).slides
+    ]
+    for name, to_dict in [
+        ("legacy object_to_dict", legacy_object_to_dict),
+        ("attribute schema", object_to_dict),
+    ]:
+        start = perf_counter()
+        for _ in range(repeat):
+            for fonts in slide_fonts:
+                for font in fonts:
+                    to_dict(font)
+        elapsed = perf_counter() - start
+        num_fonts = sum(len(fonts) for fonts in slide_fonts)
+        print(
+            f"{name}: {elapsed * 1000 / repeat / len(slide_fonts):.2f} ms per slide, "
+            f"{len(slide_fonts)} slides, {num_fonts} fonts"
+        )
+
+
+def parse_speed(pattern: str = "resource/*.pptx", repeat: int = 3):
+    files = sorted(glob(pattern))
+    for name, to_dict in [
+        ("legacy object_to_dict", legacy_object_to_dict),
+        ("attribute schema", object_to_dict),
+    ]:
+        presentation.object_to_dict = to_dict
+        num_slides = 0
+        elapsed = 0
+        for _ in range(repeat):
+            for file in files:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    config = Config(temp_dir, debug=False)
+                    start = perf_counter()
+                    prs = Presentation.from_file(file, config, use_cache=False)
+                    elapsed += perf_counter() - start
+                num_slides += len(prs)
+        print(
+            f"{name}: {elapsed * 1000 / num_slides:.2f} ms per slide, {num_slides} slides"
+        )
+    presentation.object_to_dict = object_to_dict
+
+
+if __name__ == "__main__":
+    func_argparse.main(parse_speed, to_dict_speed)
@@ -18,7 +18,7 @@ import PyPDF2
 import requests
 from tqdm import tqdm
 
-from presentation import Presentation
+from presentation import Presentation, load_presentations
 from utils import Config, tenacity
 
 topics = [
@@ -330,13 +330,13 @@ def dataset_stat():
         ppt_pages = 0
         ppt_images = 0
         num_ppts = 10
-        for ppt_folder in glob(f"data/{topic}/pptx/*"):
-            presentation = Presentation.from_file(
-                os.path.join(ppt_folder, "source.pptx"), config
-            )
-            ppt_stat[ppt_folder] = sum(
-                [len(slide.to_text()) for slide in presentation.slides]
-            )
+        ppt_files = [
+            os.path.join(ppt_folder, "source.pptx")
+            for ppt_folder in glob(f"data/{topic}/pptx/*")
+        ]
+        for presentation in load_presentations(ppt_files, config, summary=True):
+            ppt_folder = os.path.dirname(presentation.source_file)
+            ppt_stat[ppt_folder] = presentation.text_length
 
             ppt_text_len += ppt_stat[ppt_folder]
             ppt_pages += len(presentation)
@@ -17,7 +17,7 @@ from tqdm import tqdm
 from transformers import GPT2LMHeadModel, GPT2TokenizerFast
 
 import llms
-from presentation import Picture, Presentation, SlidePage
+from presentation import Presentation, PresentationSummary, load_presentations
 from utils import Config, pexists, pjoin
 
 fid.tqdm = lambda x: x
@@ -31,9 +31,8 @@ judges = [
 DEVICES = torch.cuda.device_count()
 
 
-def get_ppl(slide: SlidePage, model: GPT2LMHeadModel, tokenizer: GPT2TokenizerFast):
+def get_ppl(text: str, model: GPT2LMHeadModel, tokenizer: GPT2TokenizerFast):
     ppl = []
-    text = slide.to_text()
     if len(text) == 0:
         return ppl
     tokenized = tokenizer(text, return_tensors="pt").to(model.device)
@@ -45,21 +44,17 @@ def get_ppl(slide: SlidePage, model: GPT2LMHeadModel, tokenizer: GPT2TokenizerFa
     return ppl
 
 
-def eval_general(presentations: list[Presentation], evals: dict[str, list[int]]):
+def eval_general(presentations: list[PresentationSummary], evals: dict[str, list[int]]):
     for prs in presentations:
         if prs.source_file in evals["pages"]:
             continue
         evals["pages"][prs.source_file] = len(prs)
-        evals["characters"][prs.source_file] = sum(
-            [len(slide.to_text()) for slide in prs.slides]
-        )
-        evals["figures"][prs.source_file] = sum(
-            [len(list(slide.shape_filter(Picture))) for slide in prs.slides]
-        )
+        evals["characters"][prs.source_file] = prs.text_length
+        evals["figures"][prs.source_file] = prs.num_pictures
 
 
 def eval_feature(
-    presentations: list[Presentation],
+    presentations: list[PresentationSummary],
     evals: dict,
     setting: str,
 ):
@@ -77,8 +72,8 @@ def eval_feature(
             ):
                 continue
             ppl = []
-            for slide in prs.slides:
-                ppl.extend(get_ppl(slide, model, tokenizer))
+            for text in prs.slide_texts:
+                ppl.extend(get_ppl(text, model, tokenizer))
             if len(ppl) == 0:
                 continue
             evals["ppl"][prs.source_file] = sum(ppl) / len(ppl)
@@ -217,7 +212,7 @@ def eval_experiment(
     # filename dimension score
     print("start evaluation")
     if general_eval or feature_eval:
-        presentations = [Presentation.from_file(i, config) for i in prs_files]
+        presentations = list(load_presentations(prs_files, config, summary=True))
     if general_eval:
         eval_general(presentations, eval_stats)
 
@@ -245,7 +240,7 @@ def eval_baseline(
 
     if general_eval or feature_eval:
         config = Config("/tmp")
-        presentations = [Presentation.from_file(i, config) for i in prs_files]
+        presentations = list(load_presentations(prs_files, config, summary=True))
 
     if general_eval:
         eval_general(presentations, evals)
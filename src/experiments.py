@@ -17,12 +17,20 @@ from ablation import (
     PPTCrew_wo_SchemaInduction,
     PPTCrew_wo_Structure,
 )
-from model_utils import get_text_model
-from multimodal import ImageLabler
+from model_utils import EmbeddingCache, model_registry, set_embedding_cache
+from multimodal import CaptionStore, ImageLabler, set_caption_store
 from pptgen import PPTCrew
 from preprocess import process_filetype
 from presentation import Presentation
-from utils import Config, older_than, pbasename, pexists, pjoin, ppt_to_images
+from utils import (
+    Config,
+    older_than,
+    pbasename,
+    pexists,
+    pjoin,
+    ppt_to_images,
+    start_render_pool,
+)
 
 # language_model code_model vision_model
 EVAL_MODELS = [
@@ -89,7 +97,7 @@ def do_generate(
     thread_id: int,
 ):
     app_config = Config(rundir=ppt_folder, debug=debug)
-    text_model = get_text_model(f"cuda:{thread_id % torch.cuda.device_count()}")
+    text_model = model_registry.get("text", thread_id % torch.cuda.device_count())
     presentation = Presentation.from_file(
         pjoin(ppt_folder, "source.pptx"),
         app_config,
@@ -124,8 +132,18 @@ def generate_pres(
     thread_num: int = 8,
     debug: bool = False,
     topic: str = "*",
+    llm_cache: str = None,
+    replay: bool = False,
+    embedding_cache: str = None,
+    caption_cache: str = None,
 ):
     agent_class, setting, model_identifier = get_setting(setting_id, ablation_id)
+    if llm_cache is not None:
+        llms.set_response_cache(llms.ResponseCache(llm_cache, replay=replay))
+    if embedding_cache is not None:
+        set_embedding_cache(EmbeddingCache(cache_dir=embedding_cache))
+    if caption_cache is not None:
+        set_caption_store(CaptionStore(caption_cache))
     setting = setting_name or setting
     print("generating slides using:", setting)
     generate = partial(
@@ -138,7 +156,9 @@ def generate_pres(
     process_filetype("pptx", generate, thread_num, topic)
 
 
-def pptx2images(settings: str = "*"):
+def pptx2images(settings: str = "*", render_workers: int = 0):
+    if render_workers > 0:
+        start_render_pool(render_workers)
     while True:
         for folder in glob(f"data/*/pptx/*/{settings}/*/history"):
             folder = os.path.dirname(folder)
@@ -1,35 +1,84 @@
 import asyncio
+import atexit
 import base64
+import hashlib
+import json
 import os
 import re
+import threading
+from copy import copy
 from dataclasses import asdict, dataclass
 from math import ceil
 
+import aiohttp
 import jsonlines
-import requests
 import tiktoken
 import yaml
 from FlagEmbedding import BGEM3FlagModel
 from jinja2 import Environment, Template
 from oaib import Auto
-from openai import OpenAI
+from openai import AsyncOpenAI
 from PIL import Image
 from torch import Tensor, cosine_similarity
 
 from model_utils import get_text_embedding
-from utils import get_json_from_response, pexists, pjoin, print, tenacity
+from utils import get_json_from_response, pexists, pjoin, print, save_json, tenacity
 
 ENCODING = tiktoken.encoding_for_model("gpt-4o")
 
 
+class LLMEventLoop:
+    # one loop per process on its own thread, sync callers of any thread submit to it
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop = None
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="llm-event-loop", daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def run(self, coroutine):
+        loop = self.get_loop()
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError("blocking llm call inside the llm event loop, await it")
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def close(self):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    async def _shutdown(self):
+        # pending calls are cancelled, their callers get a CancelledError
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client_pool.aclose()
+
+
+# kept across importlib.reload, which the backend does in debug mode
+if "llm_loop" not in globals():
+    llm_loop = LLMEventLoop()
+    atexit.register(llm_loop.close)
+
+
 def run_async(coroutine):
-    try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    job = loop.run_until_complete(coroutine)
-    return job
+    return llm_loop.run(coroutine)
 
 
 def calc_image_tokens(images: list[str]):
@@ -50,6 +99,111 @@ def calc_image_tokens(images: list[str]):
     return tokens
 
 
+class ResponseCache:
+    def __init__(self, cache_dir: str, max_size: int = 2**30, replay: bool = False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.replay = replay
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(cache_dir))
+
+    def key(self, model: str, messages: list) -> str:
+        normalized = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = [
+                    (
+                        {
+                            "type": "image_url",
+                            "digest": hashlib.sha256(
+                                part["image_url"]["url"].encode()
+                            ).hexdigest(),
+                        }
+                        if part["type"] == "image_url"
+                        else part
+                    )
+                    for part in content
+                ]
+            normalized.append({"role": message["role"], "content": content})
+        return hashlib.sha256(
+            json.dumps([model, normalized], ensure_ascii=False).encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        cache_file = pjoin(self.cache_dir, f"{key}.json")
+        try:
+            with open(cache_file, "r") as f:
+                response = json.load(f)["response"]
+            os.utime(cache_file)
+            return response
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            if self.replay:
+                raise RuntimeError(f"Response {key} not found in replay mode")
+            return None
+
+    def set(self, key: str, response: str):
+        if self.replay:
+            return
+        cache_file = pjoin(self.cache_dir, f"{key}.json")
+        with self._lock:
+            if pexists(cache_file):
+                self._size -= os.path.getsize(cache_file)
+            save_json({"response": response}, cache_file, indent=None)
+            self._size += os.path.getsize(cache_file)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(
+            [i for i in os.scandir(self.cache_dir) if i.name.endswith(".json")],
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in entries:
+            if self._size <= self.max_size * 0.9:
+                break
+            self._size -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+class AsyncClientPool:
+    # only used on the llm event loop, so one session, client and semaphore per endpoint
+    def __init__(self, max_concurrency: int = 16):
+        self.max_concurrency = max_concurrency
+        self._session: aiohttp.ClientSession = None
+        self._openai_clients: dict[str, AsyncOpenAI] = {}
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    def openai_client(self, api_base: str = None) -> AsyncOpenAI:
+        if api_base not in self._openai_clients:
+            self._openai_clients[api_base] = AsyncOpenAI(base_url=api_base)
+        return self._openai_clients[api_base]
+
+    def semaphore(self, endpoint: str) -> asyncio.Semaphore:
+        if endpoint not in self._semaphores:
+            self._semaphores[endpoint] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[endpoint]
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+        for client in self._openai_clients.values():
+            await client.close()
+        self._session = None
+        self._openai_clients = {}
+        self._semaphores = {}
+
+
+if "client_pool" not in globals():
+    client_pool = AsyncClientPool()
+
+
 class LLM:
     def __init__(
         self,
@@ -57,9 +211,8 @@ class LLM:
         api_base: str = None,
         use_openai: bool = True,
         use_batch: bool = False,
+        cache: "ResponseCache" = None,
     ) -> None:
-        if use_openai and "OPENAI_API_KEY" in os.environ:
-            self.client = OpenAI(base_url=api_base)
         if use_batch and "OPENAI_API_KEY" in os.environ:
             assert use_openai, "use_batch must be used with use_openai"
             self.oai_batch = Auto(loglevel=0)
@@ -69,8 +222,8 @@ class LLM:
         self.api_base = api_base
         self._use_openai = use_openai
         self._use_batch = use_batch
+        self.cache = cache
 
-    @tenacity
     def __call__(
         self,
         content: str,
@@ -80,6 +233,28 @@ class LLM:
         delay_batch: bool = False,
         return_json: bool = False,
         return_message: bool = False,
+    ) -> str | dict | list:
+        return run_async(
+            self.acall(
+                content,
+                images,
+                system_message,
+                history,
+                delay_batch,
+                return_json,
+                return_message,
+            )
+        )
+
+    async def acall(
+        self,
+        content: str,
+        images: list[str] = None,
+        system_message: str = None,
+        history: list = None,
+        delay_batch: bool = False,
+        return_json: bool = False,
+        return_message: bool = False,
     ) -> str | dict | list:
         if content.startswith("You are"):
             system_message, content = content.split("\n", 1)
@@ -87,9 +262,51 @@ class LLM:
             history = []
         if isinstance(images, str):
             images = [images]
-        system, message = self.format_message(content, images, system_message)
+        # image encoding and embeddings run off the shared loop
+        system, message = await asyncio.to_thread(
+            self.format_message, content, images, system_message
+        )
+        if self.cache is not None and not delay_batch:
+            # file io and eviction of the cache stay off the shared loop
+            cache_key = self.cache.key(self.model, system + history + message)
+            response = await asyncio.to_thread(self.cache.get, cache_key)
+            if response is None:
+                response = await self._acomplete(
+                    system, history, message, system_message, content, return_json
+                )
+                await asyncio.to_thread(self.cache.set, cache_key, response)
+        else:
+            response = await self._acomplete(
+                system,
+                history,
+                message,
+                system_message,
+                content,
+                return_json,
+                delay_batch,
+            )
+            if delay_batch:
+                return
+        message.append({"role": "assistant", "content": response})
+        if return_json:
+            response = get_json_from_response(response)
+        if return_message:
+            response = (response, message)
+        return response
+
+    @tenacity
+    async def _acomplete(
+        self,
+        system: list,
+        history: list,
+        message: list,
+        system_message: str,
+        content: str,
+        return_json: bool = False,
+        delay_batch: bool = False,
+    ) -> str:
         if self._use_batch:
-            result = run_async(self._run_batch(system + history + message, delay_batch))
+            result = await self._run_batch(system + history + message, delay_batch)
             if delay_batch:
                 return
             try:
@@ -100,32 +317,37 @@ class LLM:
                 print("Failed to get response from batch")
                 raise e
         elif self._use_openai:
-            completion = self.client.chat.completions.create(
-                model=self.model, messages=system + history + message
-            )
+            async with client_pool.semaphore(self.endpoint):
+                completion = await client_pool.openai_client(
+                    self.api_base
+                ).chat.completions.create(
+                    model=self.model, messages=system + history + message
+                )
             response = completion.choices[0].message.content
         else:
-            response = requests.post(
-                self.api_base,
-                json={
-                    "system": system_message,
-                    "prompt": content,
-                    "image": [
-                        i["image_url"]["url"]
-                        for i in message[-1]["content"]
-                        if i["type"] == "image_url"
-                    ],
-                },
-            )
-            response.raise_for_status()
-            response = response.text
-        message.append({"role": "assistant", "content": response})
+            async with client_pool.semaphore(self.endpoint):
+                async with client_pool.session().post(
+                    self.api_base,
+                    json={
+                        "system": system_message,
+                        "prompt": content,
+                        "image": [
+                            i["image_url"]["url"]
+                            for i in message[-1]["content"]
+                            if i["type"] == "image_url"
+                        ],
+                    },
+                ) as http_response:
+                    http_response.raise_for_status()
+                    response = await http_response.text()
         if return_json:
-            response = get_json_from_response(response)
-        if return_message:
-            response = (response, message)
+            get_json_from_response(response)
         return response
 
+    @property
+    def endpoint(self) -> str:
+        return self.api_base or "openai"
+
     def __repr__(self) -> str:
         return f"LLM(model={self.model}, api_base={self.api_base})"
 
@@ -241,6 +463,18 @@ class Role:
         self.input_tokens = 0
         self.output_tokens = 0
         self.history: list[Turn] = []
+        self._inflight: asyncio.Semaphore = None
+
+    def set_max_inflight(self, max_inflight: int):
+        # shared with forked roles, so it caps the requests of all slides,
+        # every call runs on the llm event loop so an asyncio semaphore suffices
+        self._inflight = asyncio.Semaphore(max_inflight)
+
+    async def _acall_llm(self, prompt: str, **kwargs):
+        if self._inflight is None:
+            return await self.llm.acall(prompt, return_message=True, **kwargs)
+        async with self._inflight:
+            return await self.llm.acall(prompt, return_message=True, **kwargs)
 
     def calc_cost(self, turns: list[Turn]):
         for turn in turns:
@@ -276,17 +510,30 @@ class Role:
             for turn in self.history:
                 writer.write(turn.to_dict())
 
+    def fork(self):
+        role = copy(self)
+        role.history = []
+        role.input_tokens = 0
+        role.output_tokens = 0
+        return role
+
+    def merge(self, role: "Role"):
+        for turn in role.history:
+            turn.id = len(self.history)
+            self.history.append(turn)
+        self.input_tokens += role.input_tokens
+        self.output_tokens += role.output_tokens
+
     def retry(self, feedback: str, traceback: str, error_idx: int):
+        return run_async(self.aretry(feedback, traceback, error_idx))
+
+    async def aretry(self, feedback: str, traceback: str, error_idx: int):
         assert error_idx > 0, "error_idx must be greater than 0"
         prompt = self.retry_template.render(feedback=feedback, traceback=traceback)
         history = []
         for turn in self.history[-error_idx:]:
             history.extend(turn.message)
-        response, message = self.llm(
-            prompt,
-            history=history,
-            return_message=True,
-        )
+        response, message = await self._acall_llm(prompt, history=history)
         turn = Turn(
             id=len(self.history),
             prompt=prompt,
@@ -304,22 +551,30 @@ class Role:
         recent: int = 0,
         similar: int = 0,
         **jinja_args,
+    ):
+        return run_async(self.acall(images, recent, similar, **jinja_args))
+
+    async def acall(
+        self,
+        images: list[str] = None,
+        recent: int = 0,
+        similar: int = 0,
+        **jinja_args,
     ):
         if isinstance(images, str):
             images = [images]
         assert self.prompt_args == set(jinja_args.keys()), "Invalid arguments"
         prompt = self.template.render(**jinja_args)
-        history = self.get_history(similar, recent, prompt)
+        history = await asyncio.to_thread(self.get_history, similar, recent, prompt)
         history_msg = []
         for turn in history:
             history_msg.extend(turn.message)
 
-        response, message = self.llm(
+        response, message = await self._acall_llm(
             prompt,
             system_message=self.system_message,
             history=history_msg,
             images=images,
-            return_message=True,
         )
         turn = Turn(
             id=len(self.history),
@@ -328,7 +583,9 @@ class Role:
             message=message,
             images=images,
         )
-        return self.__post_process__(response, history, turn, similar)
+        return await asyncio.to_thread(
+            self.__post_process__, response, history, turn, similar
+        )
 
     def __post_process__(
         self, response: str, history: list[Turn], turn: Turn, similar: int = 0
@@ -344,6 +601,12 @@ class Role:
         return response
 
 
+def set_response_cache(cache: ResponseCache):
+    for llm in globals().values():
+        if isinstance(llm, LLM):
+            llm.cache = cache
+
+
 def get_simple_modelname(llms: list[LLM]):
     if isinstance(llms, LLM):
         llms = [llms]
@@ -1,6 +1,11 @@
+import hashlib
 import json
 import os
-from copy import deepcopy
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable
 
 import numpy as np
 import torch
@@ -14,7 +19,7 @@ from torchvision.transforms.functional import InterpolationMode
 from transformers import AutoFeatureExtractor, AutoModel
 
 from presentation import Presentation
-from utils import is_image_path, pjoin
+from utils import atomic_write, is_image_path, pjoin
 
 device_count = torch.cuda.device_count()
 
@@ -61,6 +66,86 @@ def get_image_model(device: str = None):
     )
 
 
+def get_marker_model(device: str = None):
+    # require numpy==1.26.0, which is conflict with other packages
+    from marker.models import create_model_dict
+
+    return create_model_dict(device=device, dtype=torch.float16)
+
+
+class ModelRegistry:
+    def __init__(self, idle_timeout: float = None):
+        self.loaders: dict[str, Callable[[str], Any]] = {
+            "text": get_text_model,
+            "image": get_image_model,
+            "marker": get_marker_model,
+        }
+        self.idle_timeout = idle_timeout
+        self.models: dict[tuple[str, str], Any] = {}
+        self.last_used: dict[tuple[str, str], float] = {}
+        self.in_use: dict[tuple[str, str], int] = {}
+        self._load_locks: dict[tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str, device: int | str = None):
+        # loaded on first use and shared by every caller asking for the same device,
+        # may be evicted while still held, long running users should pin it with use
+        return self._load(name, device, pin=False)
+
+    @contextmanager
+    def use(self, name: str, device: int | str = None):
+        # pinned models are not evicted, so the next get does not load a second copy
+        model = self._load(name, device, pin=True)
+        key = self._key(name, device)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self.in_use[key] -= 1
+                self.last_used[key] = time.time()
+
+    def _key(self, name: str, device: int | str) -> tuple[str, str]:
+        if isinstance(device, int):
+            device = f"cuda:{device}"
+        return name, device
+
+    def _load(self, name: str, device: int | str, pin: bool):
+        key = self._key(name, device)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            with self._lock:
+                model = self.models.get(key)
+            if model is None:
+                model = self.loaders[name](key[1])
+            with self._lock:
+                self.models[key] = model
+                self.last_used[key] = time.time()
+                if pin:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+        self.evict_idle()
+        return model
+
+    def evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        now = time.time()
+        with self._lock:
+            idle_keys = [
+                key
+                for key, last_used in self.last_used.items()
+                if now - last_used > self.idle_timeout and self.in_use.get(key, 0) == 0
+            ]
+            for key in idle_keys:
+                self.models.pop(key, None)
+                self.last_used.pop(key, None)
+        if len(idle_keys) != 0 and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+model_registry = ModelRegistry()
+
+
 def parse_pdf(
     pdf_path: str,
     output_path: str,
@@ -91,17 +176,77 @@ def parse_pdf(
     return full_text
 
 
+class EmbeddingCache:
+    def __init__(self, max_size: int = 65536, cache_dir: str = None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self._embeddings: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode()).hexdigest()
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            if key in self._embeddings:
+                self._embeddings.move_to_end(key)
+                return self._embeddings[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            embedding = np.load(pjoin(self.cache_dir, f"{key}.npy"))
+        except (FileNotFoundError, ValueError, EOFError):
+            return None
+        self._remember(key, embedding)
+        return embedding
+
+    def set(self, key: str, embedding: np.ndarray):
+        self._remember(key, embedding)
+        if self.cache_dir is None:
+            return
+        with atomic_write(pjoin(self.cache_dir, f"{key}.npy"), "wb") as f:
+            np.save(f, embedding)
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        with self._lock:
+            self._embeddings[key] = embedding
+            self._embeddings.move_to_end(key)
+            while len(self._embeddings) > self.max_size:
+                self._embeddings.popitem(last=False)
+
+
+embedding_cache = EmbeddingCache()
+
+
+def set_embedding_cache(cache: EmbeddingCache):
+    global embedding_cache
+    embedding_cache = cache
+
+
 def get_text_embedding(text: list[str], model, batchsize: int = 32):
     if isinstance(text, str):
-        return torch.tensor(model.encode(text)["dense_vecs"]).to(model.device)
-    result = []
-    for i in range(0, len(text), batchsize):
-        result.extend(
-            torch.tensor(model.encode(text[i : i + batchsize])["dense_vecs"]).to(
-                model.device
-            )
-        )
-    return result
+        return get_text_embedding([text], model, batchsize)[0]
+    model_name = getattr(model, "model_name_or_path", model.__class__.__name__)
+    keys = [embedding_cache.key(model_name, i) for i in text]
+    embeddings = [embedding_cache.get(key) for key in keys]
+    missing = list(
+        dict.fromkeys(text[i] for i, vec in enumerate(embeddings) if vec is None)
+    )
+    encoded = {}
+    for i in range(0, len(missing), batchsize):
+        batch = missing[i : i + batchsize]
+        for sentence, vec in zip(batch, model.encode(batch)["dense_vecs"]):
+            embedding_cache.set(embedding_cache.key(model_name, sentence), vec)
+            encoded[sentence] = vec
+    embeddings = [
+        encoded[sentence] if vec is None else vec
+        for sentence, vec in zip(text, embeddings)
+    ]
+    if len(embeddings) == 0:
+        return []
+    return list(torch.tensor(np.stack(embeddings)).to(model.device))
 
 
 def get_image_embedding(image_dir: str, extractor, model, batchsize: int = 16):
@@ -127,14 +272,22 @@ def get_image_embedding(image_dir: str, extractor, model, batchsize: int = 16):
     return {image: embedding.flatten() for image, embedding in zip(images, embeddings)}
 
 
-def images_cosine_similarity(embeddings: list[torch.Tensor]):
-    embeddings = [embedding for embedding in embeddings]
+def images_cosine_similarity(
+    embeddings: list[torch.Tensor],
+    chunk_size: int = 1024,
+    dtype: torch.dtype = torch.float32,
+):
+    if len(embeddings) == 0:
+        return torch.zeros((0, 0))
+    embeddings = torch.nn.functional.normalize(
+        torch.stack(list(embeddings)).float(), dim=-1, eps=1e-8
+    ).to(dtype)
     sim_matrix = torch.zeros((len(embeddings), len(embeddings)))
-    for i in range(len(embeddings)):
-        for j in range(i + 1, len(embeddings)):
-            sim_matrix[i, j] = sim_matrix[j, i] = torch.cosine_similarity(
-                embeddings[i], embeddings[j], -1
-            )
+    for i in range(0, len(embeddings), chunk_size):
+        sim_matrix[i : i + chunk_size] = (
+            (embeddings[i : i + chunk_size] @ embeddings.T).float().cpu()
+        )
+    sim_matrix.fill_diagonal_(0)
     return sim_matrix
 
 
@@ -142,54 +295,41 @@ IMAGENET_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_STD = (0.229, 0.224, 0.225)
 
 
-def average_distance(similarity, idx, cluster_idx):
-    """
-    Calculate the average distance between a point (idx) and a cluster (cluster_idx).
-    """
-    if idx in cluster_idx:
-        return 0
-    total_similarity = 0
-    for idx_in_cluster in cluster_idx:
-        total_similarity += similarity[idx, idx_in_cluster]
-    return total_similarity / len(cluster_idx)
-
-
 def get_cluster(similarity: np.ndarray, sim_bound: float = 0.65):
+    similarity = np.array(similarity)
     num_points = similarity.shape[0]
     clusters = []
-    sim_copy = deepcopy(similarity)
-    added = [False] * num_points
+    # summed similarity between each cluster and every point, kept in merge order
+    cluster_sims = np.zeros((0, num_points), dtype=similarity.dtype)
+    cluster_sizes = []
+    added = np.zeros(num_points, dtype=bool)
+    remaining = similarity.copy()
     while True:
-        max_avg_dist = sim_bound
-        best_cluster = None
-        best_point = None
-
-        for c in clusters:
-            for point_idx in range(num_points):
-                if added[point_idx]:
-                    continue
-                avg_dist = average_distance(sim_copy, point_idx, c)
-                if avg_dist > max_avg_dist:
-                    max_avg_dist = avg_dist
-                    best_cluster = c
-                    best_point = point_idx
-
-        if best_point is not None:
-            best_cluster.append(best_point)
-            added[best_point] = True
-            similarity[best_point, :] = 0
-            similarity[:, best_point] = 0
-        else:
-            if similarity.max() < sim_bound:
-                break
-            i, j = np.unravel_index(np.argmax(similarity), similarity.shape)
-            clusters.append([int(i), int(j)])
-            added[i] = True
-            added[j] = True
-            similarity[i, :] = 0
-            similarity[:, i] = 0
-            similarity[j, :] = 0
-            similarity[:, j] = 0
+        if len(clusters) != 0 and not added.all():
+            avg_sims = (
+                cluster_sims / np.array(cluster_sizes, dtype=similarity.dtype)[:, None]
+            )
+            avg_sims[:, added] = -np.inf
+            best_cluster, best_point = np.unravel_index(
+                np.argmax(avg_sims), avg_sims.shape
+            )
+            if avg_sims[best_cluster, best_point] > sim_bound:
+                clusters[best_cluster].append(int(best_point))
+                cluster_sims[best_cluster] += similarity[best_point]
+                cluster_sizes[best_cluster] += 1
+                added[best_point] = True
+                remaining[best_point, :] = 0
+                remaining[:, best_point] = 0
+                continue
+        if remaining.max() < sim_bound:
+            break
+        i, j = np.unravel_index(np.argmax(remaining), remaining.shape)
+        clusters.append([int(i), int(j)])
+        cluster_sims = np.vstack([cluster_sims, similarity[i] + similarity[j]])
+        cluster_sizes.append(2)
+        added[[i, j]] = True
+        remaining[[i, j], :] = 0
+        remaining[:, [i, j]] = 0
     return clusters
 
 
@@ -1,11 +1,88 @@
+import hashlib
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator
 
 import PIL.Image
 from rich import print
 
 import llms
 from presentation import Picture, Presentation
-from utils import Config, pbasename, pexists, pjoin
+from utils import Config, pbasename, pexists, pjoin, save_json
+
+CAPTION_WORKERS = 8
+
+
+class CaptionStore:
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, model: str, prompt: str, image_path: str) -> str:
+        # by content, the same image is shared across templates and documents
+        with open(image_path, "rb") as f:
+            image_digest = hashlib.sha256(f.read()).hexdigest()
+        prompt_digest = hashlib.sha256(prompt.encode()).hexdigest()
+        return hashlib.sha256(
+            f"{model}\0{prompt_digest}\0{image_digest}".encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        try:
+            with open(pjoin(self.cache_dir, f"{key}.json"), "r") as f:
+                return json.load(f)["caption"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def set(self, key: str, caption: str):
+        save_json(
+            {"caption": caption}, pjoin(self.cache_dir, f"{key}.json"), indent=None
+        )
+
+
+caption_store: CaptionStore = None
+
+
+def set_caption_store(store: CaptionStore):
+    global caption_store
+    caption_store = store
+
+
+def caption_concurrently(
+    image_paths: list[str], max_workers: int = CAPTION_WORKERS
+) -> Iterator[tuple[str, str | Exception]]:
+    # yields in completion order, a failed caption is yielded as its exception
+    caption_prompt = open("prompts/caption.txt").read()
+    store, model = caption_store, llms.vision_model.model
+    keys, misses = {}, image_paths
+    if store is not None:
+        misses = []
+        for image_path in image_paths:
+            keys[image_path] = store.key(model, caption_prompt, image_path)
+            caption = store.get(keys[image_path])
+            if caption is None:
+                misses.append(image_path)
+            else:
+                yield image_path, caption
+    executor = ThreadPoolExecutor(max(1, max_workers))
+    try:
+        futures = {
+            executor.submit(llms.vision_model, caption_prompt, image_path): image_path
+            for image_path in misses
+        }
+        for future in as_completed(futures):
+            image_path = futures[future]
+            try:
+                caption = future.result()
+            except Exception as e:
+                caption = e
+            else:
+                if store is not None:
+                    store.set(keys[image_path], caption)
+            yield image_path, caption
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 class ImageLabler:
@@ -28,27 +105,38 @@ class ImageLabler:
                 stats = self.image_stats[pbasename(shape.img_path)]
                 shape.caption = stats["caption"]
 
-    def caption_images(self):
-        caption_prompt = open("prompts/caption.txt").read()
-        for image, stats in self.image_stats.items():
-            if "caption" not in stats:
-                stats["caption"] = llms.vision_model(
-                    caption_prompt, pjoin(self.config.IMAGE_DIR, image)
-                )
-                print("captioned", image, ": ", stats["caption"])
-        json.dump(
-            self.image_stats,
-            open(self.stats_file, "w"),
-            indent=4,
-            ensure_ascii=False,
-        )
+    def caption_images(
+        self,
+        progress_callback: Callable[[int, int], None] = None,
+        max_workers: int = CAPTION_WORKERS,
+    ):
+        uncaptioned = [
+            pjoin(self.config.IMAGE_DIR, image)
+            for image, stats in self.image_stats.items()
+            if "caption" not in stats
+        ]
+        num_finished = len(self.image_stats) - len(uncaptioned)
+        if progress_callback is not None:
+            progress_callback(num_finished, len(self.image_stats))
+        for image_path, caption in caption_concurrently(uncaptioned, max_workers):
+            if isinstance(caption, Exception):
+                raise caption
+            image = pbasename(image_path)
+            self.image_stats[image]["caption"] = caption
+            print("captioned", image, ": ", caption)
+            # persisted after every caption so a crash only loses inflight ones
+            save_json(self.image_stats, self.stats_file)
+            num_finished += 1
+            if progress_callback is not None:
+                progress_callback(num_finished, len(self.image_stats))
+        save_json(self.image_stats, self.stats_file)
         self.apply_stats()
         return self.image_stats
 
     def collect_images(self):
         for slide_index, slide in enumerate(self.presentation.slides):
             for shape in slide.shape_filter(Picture):
-                image_path = pbasename(shape.data[0])
+                image_path = pbasename(shape.img_path)
                 self.image_stats[image_path] = {
                     "appear_times": 0,
                     "slide_numbers": set(),
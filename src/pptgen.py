@@ -1,10 +1,13 @@
 import json
 import os
+import threading
 import traceback
 from abc import ABC, abstractmethod
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy, deepcopy
 from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Callable
 
 import jsonlines
 import PIL.Image
@@ -19,6 +22,9 @@ from model_utils import get_text_embedding
 from presentation import Presentation, SlidePage
 from utils import Config, get_slide_content, pexists, pjoin, tenacity
 
+# validated outline layout -> template layout, shared across documents of a template
+LAYOUT_MAPPINGS: dict[tuple[str, ...], dict[str, str]] = {}
+
 
 @dataclass
 class PPTGen(ABC):
@@ -31,13 +37,23 @@ class PPTGen(ABC):
         force_pages: bool = False,
         error_exit: bool = True,
         record_cost: bool = True,
+        max_workers: int = 1,
+        max_inflight: int | dict[str, int] = None,
         **kwargs,
     ):
         self.text_model = text_model
         self.retry_times = retry_times
         self.force_pages = force_pages
         self.error_exit = error_exit
+        self.max_workers = max_workers
+        self._build_lock = threading.Lock()
         self._hire_staffs(record_cost, **kwargs)
+        # pipeline mode: every slide runs at once, llm requests are capped per role
+        self.pipeline = max_inflight is not None
+        if isinstance(max_inflight, int):
+            max_inflight = {role: max_inflight for role in self.staffs}
+        for role, limit in (max_inflight or {}).items():
+            self.staffs[role].set_max_inflight(limit)
 
     def set_examplar(
         self,
@@ -51,7 +67,7 @@ class PPTGen(ABC):
         self.layout_embeddings = torch.stack(
             get_text_embedding(self.layout_names, self.text_model)
         )
-        self.empty_prs = deepcopy(presentation)
+        self.empty_prs = presentation.clone()
         return self
 
     def generate_pres(
@@ -60,6 +76,7 @@ class PPTGen(ABC):
         images: dict[str, str],
         num_slides: int,
         doc_json: dict[str, str],
+        progress_callback: Callable[[int, int], None] = None,
     ):
         self.config = config
         self.doc_json = doc_json
@@ -85,11 +102,15 @@ class PPTGen(ABC):
                 for slide_idx, slide_title in enumerate(self.outline)
             ]
         )
+        slides_data = list(enumerate(self.outline.items()))
+        if self.force_pages:
+            slides_data = slides_data[:num_slides]
         generated_slides = []
-        for slide_data in enumerate(self.outline.items()):
-            if self.force_pages and slide_data[0] == num_slides:
-                break
-            slide = self._generate_slide(slide_data, code_executor)
+        for num_finished, slide in enumerate(
+            self._generate_slides(slides_data, code_executor), 1
+        ):
+            if progress_callback is not None:
+                progress_callback(num_finished, len(slides_data))
             if slide is not None:
                 generated_slides.append(slide)
                 continue
@@ -101,6 +122,43 @@ class PPTGen(ABC):
             self.empty_prs.slides = generated_slides
             self.empty_prs.save(pjoin(self.config.RUN_DIR, "final.pptx"))
 
+    def _generate_slides(self, slides_data: list, code_executor: CodeExecutor):
+        num_workers = len(slides_data) if self.pipeline else self.max_workers
+        if num_workers <= 1:
+            for slide_data in slides_data:
+                yield self._generate_slide(slide_data, code_executor)
+            return
+        # every slide gets forked roles and executor, merged back in outline order
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = [
+                executor.submit(self._fork()._generate_forked_slide, slide_data)
+                for slide_data in slides_data
+            ]
+            try:
+                for future in futures:
+                    slide, worker, worker_executor = future.result()
+                    for name, role in worker.staffs.items():
+                        self.staffs[name].merge(role)
+                    code_executor.merge(worker_executor)
+                    yield slide
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _fork(self):
+        worker = copy(self)
+        worker.staffs = {name: role.fork() for name, role in self.staffs.items()}
+        return worker
+
+    def _generate_forked_slide(self, slide_data):
+        code_executor = CodeExecutor(self.retry_times)
+        slide = self._generate_slide(slide_data, code_executor)
+        return slide, self, code_executor
+
+    def _build_slide(self, slide: SlidePage):
+        with self._build_lock:
+            self.empty_prs.build_slide(slide)
+
     def _save_history(self, code_executor: CodeExecutor):
         os.makedirs(pjoin(self.config.RUN_DIR, "history"), exist_ok=True)
         for role in self.staffs.values():
@@ -146,16 +204,6 @@ class PPTGen(ABC):
 
     def _valid_outline(self, outline: dict, retry: int = 0) -> dict:
         try:
-            for slide in outline.values():
-                layout_sim = torch.cosine_similarity(
-                    get_text_embedding(slide["layout"], self.text_model),
-                    self.layout_embeddings,
-                )
-                if layout_sim.max() < 0.7:
-                    raise ValueError(
-                        f"Layout `{slide['layout']}` not found, must be one of {self.layout_names}"
-                    )
-                slide["layout"] = self.layout_names[layout_sim.argmax().item()]
             if any(
                 not {"layout", "subsections", "description"}.issubset(set(slide.keys()))
                 for slide in outline.values()
@@ -163,6 +211,33 @@ class PPTGen(ABC):
                 raise ValueError(
                     "Invalid outline structure, must be a dict with layout, subsections, description"
                 )
+            layout_mapping = LAYOUT_MAPPINGS.setdefault(tuple(self.layout_names), {})
+            unknown_layouts = [
+                layout
+                for layout in dict.fromkeys(
+                    slide["layout"] for slide in outline.values()
+                )
+                if layout not in layout_mapping
+            ]
+            if len(unknown_layouts) != 0:
+                layout_sim = torch.cosine_similarity(
+                    torch.stack(
+                        get_text_embedding(unknown_layouts, self.text_model)
+                    ).unsqueeze(1),
+                    self.layout_embeddings.unsqueeze(0),
+                    dim=-1,
+                )
+                max_sim, max_idx = layout_sim.max(dim=1)
+                for layout, sim, idx in zip(
+                    unknown_layouts, max_sim.tolist(), max_idx.tolist()
+                ):
+                    if sim < 0.7:
+                        raise ValueError(
+                            f"Layout `{layout}` not found, must be one of {self.layout_names}"
+                        )
+                    layout_mapping[layout] = self.layout_names[idx]
+            for slide in outline.values():
+                slide["layout"] = layout_mapping[slide["layout"]]
         except ValueError as e:
             print(outline, e)
             if retry < self.retry_times:
@@ -252,9 +327,9 @@ class PPTCrew(PPTGen):
             command_list="\n".join([str(i) for i in command_list]),
         )
         for error_idx in range(self.retry_times):
-            edited_slide: SlidePage = deepcopy(
-                self.presentation.slides[template["template_id"] - 1]
-            )
+            edited_slide: SlidePage = self.presentation.slides[
+                template["template_id"] - 1
+            ].clone()
             feedback = code_executor.execute_actions(edit_actions, edited_slide)
             if feedback is None:
                 break
@@ -263,7 +338,7 @@ class PPTCrew(PPTGen):
                     f"Failed to generate slide, tried too many times at editing\ntraceback: {feedback[1]}"
                 )
             edit_actions = self.staffs["coder"].retry(*feedback, error_idx + 1)
-        self.empty_prs.build_slide(edited_slide)
+        self._build_slide(edited_slide)
         return edited_slide
 
     def _prepare_schema(self, content_schema: dict):
@@ -18,14 +18,19 @@ import llms
 from induct import SlideInducter
 from model_utils import (
     get_image_embedding,
-    get_image_model,
     images_cosine_similarity,
+    model_registry,
     parse_pdf,
     prs_dedup,
 )
-from multimodal import ImageLabler
+from multimodal import (
+    CaptionStore,
+    ImageLabler,
+    caption_concurrently,
+    set_caption_store,
+)
 from presentation import Picture, Presentation, SlidePage
-from utils import Config, older_than, pexists, pjoin, ppt_to_images
+from utils import Config, older_than, pexists, pjoin, ppt_to_images, save_json
 
 markdown_clean_pattern = re.compile(r"!\[.*?\]\((.*?)\)")
 device_count = torch.cuda.device_count()
@@ -62,10 +67,7 @@ def process_filetype(file_type: str, func: callable, thread_num: int, topic="*")
 
 
 def parse_pdfs(pdf_folders: list[str], idx: int):
-    # require numpy==1.26.0, which is conflict with other packages
-    from marker.models import create_model_dict
-
-    model = create_model_dict(device=idx % device_count, dtype=torch.float16)
+    model = model_registry.get("marker", idx % device_count)
     for pdf_folder in pdf_folders:
         if not older_than(pdf_folder + "/original.pdf"):
             continue
@@ -81,9 +83,9 @@ def parse_pdfs(pdf_folders: list[str], idx: int):
 
 
 def prepare_pdf_folder(pdf_folder: str, rank: int):
-    image_model = get_image_model(f"cuda:{rank % device_count}")
     if not pexists(pjoin(pdf_folder, "source.md")):
         return
+    image_model = model_registry.get("image", rank % device_count)
     if not pexists(pjoin(pdf_folder, "image_caption.json")):
         images_embeddings = get_image_embedding(pdf_folder, *image_model)
         images = [pjoin(pdf_folder, image) for image in images_embeddings]
@@ -99,12 +101,14 @@ def prepare_pdf_folder(pdf_folder: str, rank: int):
                     break
         images = [image for image in images if pexists(image)]
         image_stats = {}
-        caption_prompt = open("prompts/caption.txt").read()
-        for image in images:
-            image_stats[image] = llms.vision_model(caption_prompt, image)
-            print(image_stats[image])
-        with open(pjoin(pdf_folder, "image_caption.json"), mode="w") as f:
-            json.dump(image_stats, f, indent=4, ensure_ascii=False)
+        for image, caption in caption_concurrently(images):
+            if isinstance(caption, Exception):
+                raise caption
+            image_stats[image] = caption
+            print(caption)
+        # keep the input order, the file only appears once every image is captioned
+        image_stats = {image: image_stats[image] for image in images}
+        save_json(image_stats, pjoin(pdf_folder, "image_caption.json"))
 
     if not pexists(pjoin(pdf_folder, "refined_doc.json")):
         text_content = open(pjoin(pdf_folder, "source.md")).read()
@@ -210,7 +214,7 @@ def prepare_induction(induct_id: int, wait: bool = False):
         config = Config(rundir=ppt_folder)
         ppt_image_folder = pjoin(ppt_folder, "source_slides")
         template_image_folder = pjoin(ppt_folder, "template_images")
-        image_model = get_image_model(f"cuda:{rank % device_count}")
+        image_model = model_registry.get("image", rank % device_count)
         presentation = Presentation.from_file(pjoin(ppt_folder, "source.pptx"), config)
         ImageLabler(presentation, config).caption_images()
         slide_inducter = SlideInducter(
@@ -223,9 +227,11 @@ def prepare_induction(induct_id: int, wait: bool = False):
 
 
 if __name__ == "__main__":
+    # captions are shared across templates and documents of the whole corpus
+    set_caption_store(CaptionStore("data/caption_cache"))
     if sys.argv[1] == "prepare_ppt":
-        text_model = BGEM3FlagModel("BAAI/bge-m3", use_fp16=True, device=2)
-        image_model = get_image_model(3)
+        text_model = model_registry.get("text", 2)
+        image_model = model_registry.get("image", 3)
         for ppt_folder in tqdm(glob.glob("data/*/pptx/*"), desc="prepare ppt"):
             prepare_ppt_folder(ppt_folder, text_model, image_model)
     elif sys.argv[1] == "prepare_induction":
@@ -1,11 +1,19 @@
+import os
+import pickle
 import re
+import tempfile
+import threading
 import traceback
+from collections.abc import MutableSequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import copy
 from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Iterator
 
 from pptx import Presentation as PPTXPre
 from pptx.enum.shapes import MSO_SHAPE_TYPE
 from pptx.oxml import parse_xml
+from pptx.parts.image import Image as PPTXImage
 from pptx.shapes.autoshape import Shape as PPTXAutoShape
 from pptx.shapes.base import BaseShape
 from pptx.shapes.connector import Connector as PPTXConnector
@@ -22,6 +30,7 @@ from utils import (
     apply_fill,
     dict_to_object,
     extract_fill,
+    get_file_md5,
     get_font_pptcstyle,
     get_font_style,
     merge_dict,
@@ -34,12 +43,17 @@ from utils import (
 )
 
 INDENT = "\t"
+# one lock per image file, slow wmf conversions only block readers of the same image
+IMAGE_EXTRACT_LOCKS: dict[str, threading.Lock] = {}
+IMAGE_EXTRACT_LOCKS_GUARD = threading.Lock()
+# bump when the parsed structure changes to invalidate cached presentations
+PARSER_VERSION = 4
 
 
 # textframe: shape bounds font
 # paragraph: space, alignment, level, font bullet
 # run: font, hyperlink, text
-@dataclass
+@dataclass(frozen=True)
 class StyleArg:
     paragraph_id: bool = True
     element_id: bool = True
@@ -96,6 +110,7 @@ class Paragraph:
 
 class TextFrame:
     def __init__(self, shape: BaseShape, level: int):
+        self._paragraph_index: dict[int, Paragraph] = None
         if not shape.has_text_frame:
             self.is_textframe = False
             return
@@ -120,6 +135,29 @@ class TextFrame:
             [para.font for para in self.paragraphs if para.idx != -1],
         )
 
+    def clone(self):
+        text_frame = copy(self)
+        if self.is_textframe:
+            text_frame.paragraphs = [copy(para) for para in self.paragraphs]
+            text_frame._paragraph_index = None
+        return text_frame
+
+    def get_paragraph(self, idx: int) -> Paragraph | None:
+        if self._paragraph_index is None:
+            self._paragraph_index = {
+                para.idx: para for para in reversed(self.paragraphs)
+            }
+        return self._paragraph_index.get(idx)
+
+    def append_paragraph(self, para: Paragraph):
+        self.paragraphs.append(para)
+        if self._paragraph_index is not None:
+            self._paragraph_index.setdefault(para.idx, para)
+
+    def remove_paragraph(self, para: Paragraph):
+        self.paragraphs.remove(para)
+        self._paragraph_index = None
+
     def to_html(self, style_args: StyleArg):
         if not self.is_textframe:
             return ""
@@ -174,6 +212,8 @@ class ShapeElement:
         }
         self.slide_area = slide_area
         self.level = level
+        self._version = 0
+        self._html_cache: dict[StyleArg, str] = {}
 
     @classmethod
     def from_shape(
@@ -223,6 +263,29 @@ class ShapeElement:
         # obj.shape = shape
         return obj
 
+    def clone(self):
+        # share xml, fonts and other read-only data, copy what the apis mutate
+        shape = copy(self)
+        shape.style = self.style | {"shape_bounds": self.style["shape_bounds"].copy()}
+        shape.text_frame = self.text_frame.clone()
+        shape._closures = {
+            key: closures.copy() for key, closures in self._closures.items()
+        }
+        shape._html_cache = self._html_cache.copy()
+        return shape
+
+    def invalidate(self):
+        # called on every mutation, so cached html of this shape and its slide is dropped
+        self._version += 1
+        self._html_cache = {}
+
+    def get_html(self, style_args: StyleArg) -> str:
+        html = self._html_cache.get(style_args)
+        if html is None:
+            html = self.to_html(style_args)
+            self._html_cache[style_args] = html
+        return html
+
     def build(self, slide: PPTXSlide):
         return slide.shapes._shape_factory(
             slide.shapes._spTree.insert_element_before(parse_xml(self.xml), "p:extLst")
@@ -253,6 +316,7 @@ class ShapeElement:
     @left.setter
     def left(self, value):
         self.style["shape_bounds"]["left"] = value
+        self.invalidate()
 
     @property
     def top(self):
@@ -261,6 +325,7 @@ class ShapeElement:
     @top.setter
     def top(self, value):
         self.style["shape_bounds"]["top"] = value
+        self.invalidate()
 
     @property
     def width(self):
@@ -269,6 +334,7 @@ class ShapeElement:
     @width.setter
     def width(self, value):
         self.style["shape_bounds"]["width"] = value
+        self.invalidate()
 
     @property
     def height(self):
@@ -277,6 +343,7 @@ class ShapeElement:
     @height.setter
     def height(self, value):
         self.style["shape_bounds"]["height"] = value
+        self.invalidate()
 
     @property
     def area(self):
@@ -363,7 +430,16 @@ class TextBox(ShapeElement):
         )
 
 
+def image_extract_lock(img_path: str) -> threading.Lock:
+    with IMAGE_EXTRACT_LOCKS_GUARD:
+        return IMAGE_EXTRACT_LOCKS.setdefault(img_path, threading.Lock())
+
+
 class Picture(ShapeElement):
+    # image blob not written to disk yet, extracted on first access of img_path,
+    # in lazy presentations a failed extraction raises there instead of skipping the slide
+    _pending_image: PPTXImage = None
+
     @classmethod
     def from_shape(
         cls,
@@ -382,13 +458,8 @@ class Picture(ShapeElement):
         )
         if shape.image.ext == "wmf":
             img_path = img_path.replace(".wmf", ".jpg")
-            if not pexists(img_path):
-                wmf_to_images(shape.image.blob, img_path)
         elif shape.image.ext not in IMAGE_EXTENSIONS:
             raise ValueError(f"unsupported image type {shape.image.ext}")
-        if not pexists(img_path):
-            with open(img_path, "wb") as f:
-                f.write(shape.image.blob)
         style["img_style"] = {
             "crop_bottom": shape.crop_bottom,
             "crop_top": shape.crop_top,
@@ -404,8 +475,42 @@ class Picture(ShapeElement):
             slide_area,
             level=level,
         )
+        if not pexists(img_path):
+            picture._pending_image = shape.image
         return picture
 
+    def extract_image(self):
+        # pending is cleared only once the file is in place, so other readers wait for it
+        with image_extract_lock(self.data[0]):
+            image = self._pending_image
+            if image is None:
+                return
+            if not pexists(self.data[0]):
+                try:
+                    self._write_image(image)
+                except Exception as e:
+                    raise RuntimeError(
+                        f"failed to extract picture {self.shape_idx} of slide {self.slide_idx}: {e}"
+                    ) from e
+            self._pending_image = None
+
+    def _write_image(self, image: PPTXImage):
+        # written aside and renamed, other processes share the image folder
+        img_dir, img_name = os.path.split(self.data[0])
+        with tempfile.TemporaryDirectory(dir=img_dir) as temp_dir:
+            temp_path = pjoin(temp_dir, img_name)
+            if image.ext == "wmf":
+                wmf_to_images(image.blob, temp_path)
+            else:
+                with open(temp_path, "wb") as f:
+                    f.write(image.blob)
+            os.replace(temp_path, self.data[0])
+
+    def clone(self):
+        shape = super().clone()
+        shape.data = self.data.copy()
+        return shape
+
     def build(self, slide: PPTXSlide):
         shape = slide.shapes.add_picture(
             self.img_path,
@@ -425,11 +530,16 @@ class Picture(ShapeElement):
 
     @property
     def img_path(self):
+        if self._pending_image is not None:
+            self.extract_image()
         return self.data[0]
 
     @img_path.setter
     def img_path(self, img_path: str):
-        self.data[0] = img_path
+        with image_extract_lock(self.data[0]):
+            self._pending_image = None
+            self.data[0] = img_path
+        self.invalidate()
 
     @property
     def caption(self):
@@ -438,6 +548,7 @@ class Picture(ShapeElement):
     @caption.setter
     def caption(self, caption: str):
         self.data[2] = caption
+        self.invalidate()
 
     def to_html(self, style_args: StyleArg) -> str:
         if not style_args.show_image:
@@ -533,6 +644,11 @@ class GroupShape(ShapeElement):
             slide_idx, shape_idx, style, data, text_frame, slide_area, level=level
         )
 
+    def clone(self):
+        shape = super().clone()
+        shape.data = [sub_shape.clone() for sub_shape in self.data]
+        return shape
+
     def build(self, slide: PPTXSlide):
         for shape in self.data:
             shape.build(slide)
@@ -541,6 +657,10 @@ class GroupShape(ShapeElement):
     def to_pptc(self):
         return "\n".join([shape.to_pptc() for shape in self.data])
 
+    def get_html(self, style_args: StyleArg) -> str:
+        # assembled from the cached html of its children
+        return self.to_html(style_args)
+
     def __iter__(self):
         for shape in self.data:
             if isinstance(shape, GroupShape):
@@ -563,7 +683,7 @@ class GroupShape(ShapeElement):
         return (
             self.indent
             + f"<div class='{self.group_label}'{self.get_inline_style(style_args)}>\n"
-            + "\n".join([shape.to_html(style_args) for shape in self.data])
+            + "\n".join([shape.get_html(style_args) for shape in self.data])
             + "\n"
             + self.indent
             + "</div>\n"
@@ -640,6 +760,8 @@ class SlidePage:
         slide_height: int,
     ):
         self.shapes = shapes
+        self._shape_index: dict[int, ShapeElement] = None
+        self._html_cache: dict[StyleArg, tuple[tuple, str]] = {}
         self.slide_idx = slide_idx
         self.real_idx = real_idx
         self.background_xml = background_xml
@@ -694,6 +816,24 @@ class SlidePage:
             slide_height,
         )
 
+    def clone(self):
+        slide = copy(self)
+        slide.shapes = [shape.clone() for shape in self.shapes]
+        slide._shape_index = None
+        slide._html_cache = {}
+        return slide
+
+    def get_shape(self, shape_idx: int) -> ShapeElement | None:
+        if self._shape_index is None:
+            self._shape_index = {
+                shape.shape_idx: shape for shape in reversed(list(self))
+            }
+        return self._shape_index.get(shape_idx)
+
+    def remove_shape(self, shape: ShapeElement):
+        self.shapes.remove(shape)
+        self._shape_index = None
+
     def build(self, slide: PPTXSlide):
         for ph in slide.placeholders:
             ph.element.getparent().remove(ph.element)
@@ -726,15 +866,26 @@ class SlidePage:
     def to_html(self, style_args: StyleArg = None, **kwargs) -> str:
         if style_args is None:
             style_args = StyleArg(**kwargs)
-        return "".join(
+        # the versions of all shapes (groups and their children) tell if any was mutated
+        signature = tuple(
+            (id(shape), shape._version)
+            for shapes in (self.shapes, self)
+            for shape in shapes
+        )
+        cached = self._html_cache.get(style_args)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        html = "".join(
             [
                 "<!DOCTYPE html>\n<html>\n",
                 (f"<title>{self.slide_title}</title>\n" if self.slide_title else ""),
                 f'<body style="width:{self.slide_width}pt; height:{self.slide_height}pt;">\n',
-                "\n".join([shape.to_html(style_args) for shape in self.shapes]),
+                "\n".join([shape.get_html(style_args) for shape in self.shapes]),
                 "</body>\n</html>\n",
             ]
         )
+        self._html_cache[style_args] = (signature, html)
+        return html
 
     def to_pptc(self):
         return "\n".join([shape.to_pptc() for shape in self.shapes])
@@ -771,6 +922,45 @@ class SlidePage:
         return len(self.shapes)
 
 
+class LazySlides(MutableSequence):
+    # slides are parsed in order on first access, as their indices depend on earlier failures
+    def __init__(self, slides: Iterator[SlidePage]):
+        self._pending = slides
+        self._slides: list[SlidePage] = []
+        self._lock = threading.Lock()
+
+    def _materialize(self, num_slides: int = None) -> list[SlidePage]:
+        with self._lock:
+            while self._pending is not None and (
+                num_slides is None or len(self._slides) < num_slides
+            ):
+                try:
+                    self._slides.append(next(self._pending))
+                except StopIteration:
+                    self._pending = None
+        return self._slides
+
+    def __getitem__(self, idx):
+        if isinstance(idx, int) and idx >= 0:
+            return self._materialize(idx + 1)[idx]
+        return self._materialize()[idx]
+
+    def __setitem__(self, idx, slide: SlidePage):
+        self._materialize()[idx] = slide
+
+    def __delitem__(self, idx):
+        del self._materialize()[idx]
+
+    def __len__(self):
+        return len(self._materialize())
+
+    def insert(self, idx: int, slide: SlidePage):
+        self._materialize().insert(idx, slide)
+
+    def __repr__(self) -> str:
+        return f"LazySlides({len(self._slides)} parsed, pending={self._pending is not None})"
+
+
 class Presentation:
     def __init__(
         self,
@@ -787,20 +977,109 @@ class Presentation:
         self.slide_height = slide_height
         self.num_pages = num_pages
         self.source_file = file_path
+        self._open_pptx()
+
+    def _open_pptx(self):
         self.prs = PPTXPre(self.source_file)
         self.layout_mapping = {layout.name: layout for layout in self.prs.slide_layouts}
         self.prs.core_properties.last_modified_by = "PPTAgent"
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("prs")
+        state.pop("layout_mapping")
+        state["slides"] = list(self.slides)
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._open_pptx()
+
+    def clone(self):
+        presentation = self.__class__.__new__(self.__class__)
+        presentation.__setstate__(
+            self.__getstate__()
+            | {
+                "slides": [slide.clone() for slide in self.slides],
+                "error_history": self.error_history.copy(),
+            }
+        )
+        return presentation
+
+    @classmethod
+    def from_file(
+        cls,
+        file_path: str,
+        config: Config,
+        use_cache: bool = True,
+        lazy: bool = False,
+    ):
+        if not use_cache:
+            return cls.parse_file(file_path, config, lazy)
+        cache_file = pjoin(
+            config.RUN_DIR,
+            "parse_cache",
+            f"{get_file_md5(file_path)}-v{PARSER_VERSION}.pkl",
+        )
+        presentation = cls.load_cache(cache_file, file_path)
+        if presentation is not None:
+            return presentation
+        presentation = cls.parse_file(file_path, config, lazy)
+        if lazy:
+            # only fully parsed presentations are cached
+            return presentation
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=os.path.dirname(cache_file), delete=False
+        ) as f:
+            pickle.dump(presentation.__getstate__(), f)
+        os.replace(f.name, cache_file)
+        return presentation
+
     @classmethod
-    def from_file(cls, file_path: str, config: Config):
+    def load_cache(cls, cache_file: str, file_path: str):
+        if not pexists(cache_file):
+            return None
+        try:
+            with open(cache_file, "rb") as f:
+                state = pickle.load(f)
+        except Exception:
+            return None
+        for slide in state["slides"]:
+            for picture in slide.shape_filter(Picture):
+                if not pexists(picture.img_path):
+                    return None
+        state["source_file"] = file_path
+        presentation = cls.__new__(cls)
+        presentation.__setstate__(state)
+        return presentation
+
+    @classmethod
+    def parse_file(cls, file_path: str, config: Config, lazy: bool = False):
         prs = PPTXPre(file_path)
+        error_history = []
+        slides = cls.iter_slides(prs, file_path, config, error_history, lazy)
+        return cls(
+            LazySlides(slides) if lazy else list(slides),
+            error_history,
+            prs.slide_width,
+            prs.slide_height,
+            file_path,
+            len(prs.slides),
+        )
+
+    @staticmethod
+    def iter_slides(
+        prs: PPTXPre,
+        file_path: str,
+        config: Config,
+        error_history: list,
+        lazy: bool,
+    ) -> Iterator[SlidePage]:
         slide_width = prs.slide_width
         slide_height = prs.slide_height
-        slides = []
-        error_history = []
         slide_idx = 0
         layouts = [layout.name for layout in prs.slide_layouts]
-        num_pages = len(prs.slides)
         for slide in prs.slides:
             if slide._element.get("show") == "0":
                 continue  # will not be printed to pdf
@@ -811,16 +1090,18 @@ class Presentation:
                     raise ValueError(
                         f"slide layout {slide.slide_layout.name} not found"
                     )
-                slides.append(
-                    SlidePage.from_slide(
-                        slide,
-                        slide_idx - len(error_history),
-                        slide_idx,
-                        slide_width.pt,
-                        slide_height.pt,
-                        config,
-                    )
+                slide_page = SlidePage.from_slide(
+                    slide,
+                    slide_idx - len(error_history),
+                    slide_idx,
+                    slide_width.pt,
+                    slide_height.pt,
+                    config,
                 )
+                if not lazy:
+                    for picture in slide_page.shape_filter(Picture):
+                        picture.extract_image()
+                yield slide_page
             except Exception as e:
                 error_history.append((slide_idx, str(e)))
                 if config.DEBUG:
@@ -828,10 +1109,6 @@ class Presentation:
                         f"Warning in slide {slide_idx} of {file_path}: {traceback.format_exc()}"
                     )
 
-        return cls(
-            slides, error_history, slide_width, slide_height, file_path, num_pages
-        )
-
     def save(self, file_path, layout_only=False):
         self.clear_slides()
         for slide in self.slides:
@@ -885,6 +1162,62 @@ class Presentation:
         return len(self.slides)
 
 
+@dataclass
+class PresentationSummary:
+    source_file: str
+    slide_texts: list[str]
+    num_pictures: int
+    num_pages: int
+    error_history: list
+
+    @classmethod
+    def from_presentation(cls, presentation: Presentation):
+        return cls(
+            presentation.source_file,
+            [slide.to_text() for slide in presentation.slides],
+            sum(
+                len(list(slide.shape_filter(Picture))) for slide in presentation.slides
+            ),
+            presentation.num_pages,
+            presentation.error_history,
+        )
+
+    @property
+    def text_length(self):
+        return sum(len(text) for text in self.slide_texts)
+
+    def __len__(self):
+        return len(self.slide_texts)
+
+
+def load_presentation(file_path: str, config: Config, summary: bool = False):
+    # summaries only need text, so their pictures are never extracted
+    presentation = Presentation.from_file(file_path, config, lazy=summary)
+    if summary:
+        return PresentationSummary.from_presentation(presentation)
+    return presentation
+
+
+def load_presentations(
+    file_paths: list[str],
+    config: Config,
+    summary: bool = False,
+    num_workers: int = None,
+) -> Iterator[Presentation | PresentationSummary]:
+    # parsed in a process pool, yielded in completion order
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(load_presentation, file_path, config, summary)
+            for file_path in file_paths
+        ]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
 SHAPECAST: dict[int, ShapeElement] = {
     MSO_SHAPE_TYPE.AUTO_SHAPE: FreeShape,
     MSO_SHAPE_TYPE.PLACEHOLDER: Placeholder,
@@ -895,15 +1228,16 @@ SHAPECAST: dict[int, ShapeElement] = {
 }
 
 if __name__ == "__main__":
-    from copy import deepcopy
     from glob import glob
 
     config = Config("/tmp")
-    presentation = deepcopy(
+    presentation = (
         Presentation.from_file("runs/pptx/cip_default_template/source.pptx", config)
-    ).save("./test.pptx")
+        .clone()
+        .save("./test.pptx")
+    )
     for pptx in glob("data/*/pptx/*/source.pptx"):
-        presentation = deepcopy(Presentation.from_file(pptx, config))
+        presentation = Presentation.from_file(pptx, config).clone()
         for slide in presentation.slides:
             print(slide.to_html(show_image=False))
             print("\033c", end="")
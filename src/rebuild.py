@@ -2,7 +2,6 @@
 import os
 import shutil
 import sys
-from copy import deepcopy
 from glob import glob
 
 import func_argparse
@@ -28,7 +27,7 @@ def rebuild_pptx(agent_steps: str, prs: Presentation):
     for mark, slide_idx, actions in steps:
         if mark != HistoryMark.API_CALL_CORRECT:
             continue
-        slides.append(deepcopy(prs.slides[slide_idx - 1]))  # slide_idx starts from 1
+        slides.append(prs.slides[slide_idx - 1].clone())  # slide_idx starts from 1
         feedback = code_executor.execute_actions(actions, slides[-1])
         assert feedback is None, feedback
     return slides
@@ -39,7 +38,7 @@ def rebuild_all(
 ):
     for folder in tqdm.tqdm(glob(f"data/{topic}/pptx/*")):
         prs = Presentation.from_file(pjoin(folder, "source.pptx"), config)
-        pptx_container = deepcopy(prs)
+        pptx_container = prs.clone()
         for agent_steps in glob(pjoin(folder, setting, "*", "agent_steps.jsonl")):
             dst = pjoin(os.path.dirname(agent_steps), out_filename)
             if os.path.exists(dst):
@@ -66,7 +65,7 @@ if __name__ == "__main__":
         pdf = "37-105-1-PB (3)"
 
         prs = Presentation.from_file(pjoin(source_folder, "source.pptx"), config)
-        container = deepcopy(prs)
+        container = prs.clone()
         container.slides = rebuild_pptx(
             pjoin(source_folder, setting, pdf, "agent_steps.jsonl"), prs
         )
@@ -0,0 +1,235 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from typing import Callable
+
+from utils import print
+
+
+class TaskQueue:
+    def __init__(self, db_path: str, lease_seconds: int = 600, max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn().execute(
+            """CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                error TEXT,
+                progress TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        columns = [row[1] for row in self._conn().execute("PRAGMA table_info(tasks)")]
+        if "progress" not in columns:
+            self._conn().execute("ALTER TABLE tasks ADD COLUMN progress TEXT")
+        self._conn().execute(
+            """CREATE TABLE IF NOT EXISTS fingerprints (
+                fingerprint TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn().execute(
+            "CREATE INDEX IF NOT EXISTS fingerprint_index ON fingerprints (fingerprint)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per thread, transactions are managed explicitly
+        if getattr(self._local, "conn", None) is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return self._local.conn
+
+    def submit(self, task_id: str, payload: dict, fingerprint: str = None):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO tasks (task_id, payload, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                (task_id, json.dumps(payload), now, now),
+            )
+            if fingerprint is not None:
+                conn.execute(
+                    "INSERT INTO fingerprints (fingerprint, task_id, created_at) VALUES (?, ?, ?)",
+                    (fingerprint, task_id, now),
+                )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    def find(self, fingerprint: str, max_age: float) -> tuple[str, str] | None:
+        # latest task of an identical request that is pending or done within max_age
+        row = (
+            self._conn()
+            .execute(
+                "SELECT tasks.task_id, tasks.status FROM fingerprints "
+                "JOIN tasks ON tasks.task_id = fingerprints.task_id "
+                "WHERE fingerprint = ? AND fingerprints.created_at >= ? "
+                "AND tasks.status IN ('queued', 'running', 'done') "
+                "ORDER BY fingerprints.created_at DESC LIMIT 1",
+                (fingerprint, time.time() - max_age),
+            )
+            .fetchone()
+        )
+        return None if row is None else tuple(row)
+
+    def claim(self, worker_id: str) -> tuple[str, dict, int] | None:
+        # queued tasks and running tasks whose worker stopped renewing the lease
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE tasks SET status = 'failed', error = 'too many attempts', updated_at = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT task_id, payload, attempts FROM tasks "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE tasks SET status = 'running', worker = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE task_id = ?",
+                    (worker_id, now + self.lease_seconds, now, row[0]),
+                )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        task_id, payload, attempts = row
+        return task_id, json.loads(payload), attempts + 1
+
+    def heartbeat(self, task_id: str, worker_id: str):
+        now = time.time()
+        self._conn().execute(
+            "UPDATE tasks SET lease_until = ?, updated_at = ? WHERE task_id = ? AND worker = ? AND status = 'running'",
+            (now + self.lease_seconds, now, task_id, worker_id),
+        )
+
+    def set_progress(self, task_id: str, message: dict):
+        # lets processes other than the running one follow the task
+        self._conn().execute(
+            "UPDATE tasks SET progress = ? WHERE task_id = ?",
+            (json.dumps(message), task_id),
+        )
+
+    def get_progress(self, task_id: str) -> dict | None:
+        row = (
+            self._conn()
+            .execute("SELECT progress FROM tasks WHERE task_id = ?", (task_id,))
+            .fetchone()
+        )
+        return None if row is None or row[0] is None else json.loads(row[0])
+
+    def complete(self, task_id: str):
+        self._finish(task_id, "done", None)
+
+    def fail(self, task_id: str, error: str):
+        self._finish(task_id, "failed", error)
+
+    def _finish(self, task_id: str, status: str, error: str):
+        self._conn().execute(
+            "UPDATE tasks SET status = ?, error = ?, lease_until = NULL, updated_at = ? WHERE task_id = ?",
+            (status, error, time.time(), task_id),
+        )
+
+    def status(self, task_id: str) -> str | None:
+        row = (
+            self._conn()
+            .execute("SELECT status FROM tasks WHERE task_id = ?", (task_id,))
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    def depth(self) -> dict[str, int]:
+        counts = {"queued": 0, "running": 0}
+        for status, count in self._conn().execute(
+            "SELECT status, COUNT(*) FROM tasks WHERE status IN ('queued', 'running') GROUP BY status"
+        ):
+            counts[status] = count
+        return counts
+
+
+class TaskWorkerPool:
+    def __init__(
+        self,
+        queue: TaskQueue,
+        handler: Callable[[str, dict, int], None],
+        num_workers: int,
+        poll_interval: float = 1.0,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.running_tasks: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(self.num_workers)
+        ]
+        self._threads.append(threading.Thread(target=self._heartbeat, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        # running tasks keep their lease and are resumed by another worker once it expires
+        self._stop.set()
+
+    def _work(self):
+        while not self._stop.is_set():
+            claimed = self.queue.claim(self.worker_id)
+            if claimed is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            task_id, payload, attempts = claimed
+            with self._lock:
+                self.running_tasks.add(task_id)
+            try:
+                self.handler(task_id, payload, attempts)
+                self.queue.complete(task_id)
+            except Exception as e:
+                traceback.print_exc()
+                if self._stop.is_set():
+                    # interrupted by shutdown, resumed once its lease expires
+                    continue
+                self.queue.fail(task_id, str(e))
+            finally:
+                with self._lock:
+                    self.running_tasks.discard(task_id)
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            with self._lock:
+                running_tasks = list(self.running_tasks)
+            for task_id in running_tasks:
+                try:
+                    self.queue.heartbeat(task_id, self.worker_id)
+                except sqlite3.Error as e:
+                    print(f"heartbeat of {task_id} failed: {e}")
@@ -1,8 +1,18 @@
+import atexit
+import fcntl
+import hashlib
+import json
 import os
+import queue
 import shutil
+import socket
 import subprocess
 import tempfile
+import threading
 import traceback
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from time import sleep, time
 from types import SimpleNamespace
 
@@ -89,6 +99,45 @@ def older_than(filepath, seconds: int = 10, wait: bool = False):
     return seconds < (current_time - file_creation_time)
 
 
+@contextmanager
+def file_lock(lock_path: str):
+    # each holder opens its own descriptor, so this excludes threads and processes alike
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_write(filepath: str, mode: str = "w"):
+    # written next to the target and renamed, readers never see a partial file,
+    # the temp name is unique across the threads and processes sharing a folder
+    temp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, mode) as f:
+            yield f
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def save_json(obj, filepath: str, indent: int = 4):
+    with atomic_write(filepath) as f:
+        json.dump(obj, f, indent=indent, ensure_ascii=False)
+
+
+def get_file_md5(filepath: str):
+    hash_md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
 def edit_distance(text1: str, text2: str):
     return 1 - Levenshtein.distance(text1, text2) / max(len(text1), len(text2))
 
@@ -136,6 +185,219 @@ tenacity = retry(
 )
 
 
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class OfficeWorker:
+    def __init__(self, profile_dir: str, timeout: int = 60):
+        self.profile_dir = profile_dir
+        self.timeout = timeout
+        self.process: subprocess.Popen = None
+        self.start()
+
+    def start(self):
+        import uno
+
+        # reaps the previous soffice, a fresh port per start avoids other backends
+        self.stop()
+        self.port = find_free_port()
+        self.process = subprocess.Popen(
+            [
+                "soffice",
+                "--headless",
+                "--invisible",
+                "--nologo",
+                "--norestore",
+                f"-env:UserInstallation=file://{os.path.abspath(self.profile_dir)}",
+                f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        start_time = time()
+        while True:
+            try:
+                context = resolver.resolve(
+                    f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+                )
+                break
+            except Exception:
+                if (
+                    time() - start_time > self.timeout
+                    or self.process.poll() is not None
+                ):
+                    self.process.kill()
+                    raise RuntimeError(f"Failed to start office worker on {self.port}")
+                sleep(0.5)
+        if self.process.poll() is not None:
+            # our soffice exited, so the port was answered by another office instance
+            raise RuntimeError(f"Office worker on {self.port} exited during startup")
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", context
+        )
+
+    def convert(self, file: str, output_file: str, filter_name: str):
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def props(**kwargs):
+            return tuple(PropertyValue(Name=k, Value=v) for k, v in kwargs.items())
+
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(file)),
+            "_blank",
+            0,
+            props(Hidden=True),
+        )
+        if document is None:
+            raise RuntimeError(f"Failed to load {file}")
+        try:
+            document.storeToURL(
+                uno.systemPathToFileUrl(os.path.abspath(output_file)),
+                props(FilterName=filter_name),
+            )
+        finally:
+            document.close(True)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.is_alive():
+            self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class RenderPool:
+    def __init__(
+        self, num_workers: int = 2, timeout: int = 300, restart_interval: int = 5
+    ):
+        self.timeout = timeout
+        self.restart_interval = restart_interval
+        self.profile_root = tempfile.mkdtemp(prefix="pptagent_office_")
+        self.jobs = queue.Queue()
+        self.running: dict[Future, OfficeWorker] = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self.workers = [
+            OfficeWorker(pjoin(self.profile_root, str(i))) for i in range(num_workers)
+        ]
+        self.threads = [
+            threading.Thread(target=self._serve, args=(worker,), daemon=True)
+            for worker in self.workers
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _restart(self, worker: OfficeWorker):
+        # keeps the thread alive, jobs wait in the queue until their timeout
+        while not worker.is_alive() and not self._closed.is_set():
+            try:
+                worker.start()
+            except Exception as e:
+                print(f"office worker restart failed: {e}")
+                sleep(self.restart_interval)
+
+    def _serve(self, worker: OfficeWorker):
+        while True:
+            self._restart(worker)
+            job = self.jobs.get()
+            if job is None:
+                worker.stop()
+                return
+            future, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self.running[future] = worker
+            try:
+                worker.convert(*args)
+                future.set_result(None)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self.running.pop(future, None)
+
+    def convert(self, file: str, output_file: str, filter_name: str):
+        future = Future()
+        self.jobs.put((future, (file, output_file, filter_name)))
+        try:
+            future.result(self.timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # hung soffice, killing it fails the call and its thread restarts it
+                with self._lock:
+                    worker = self.running.get(future)
+                if worker is not None:
+                    worker.kill()
+            raise TimeoutError(f"Converting {file} timed out after {self.timeout}s")
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        for _ in self.workers:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join(self.timeout)
+        # workers whose thread is stuck in a conversion are stopped here
+        for worker in self.workers:
+            worker.stop()
+        shutil.rmtree(self.profile_root, ignore_errors=True)
+
+
+render_pool: RenderPool = None
+
+
+def start_render_pool(num_workers: int = 2, timeout: int = 300):
+    global render_pool
+    try:
+        import uno  # noqa: F401
+    except ImportError:
+        print("python uno bindings not found, fall back to soffice subprocesses")
+        return None
+    render_pool = RenderPool(num_workers, timeout)
+    atexit.register(render_pool.close)
+    return render_pool
+
+
+def office_convert(file: str, output_dir: str, filetype: str, filter_name: str):
+    if render_pool is not None:
+        basename = os.path.splitext(os.path.basename(file))[0]
+        render_pool.convert(
+            file, pjoin(output_dir, f"{basename}.{filetype}"), filter_name
+        )
+        return
+    command_list = [
+        "soffice",
+        "--headless",
+        "--convert-to",
+        filetype,
+        file,
+        "--outdir",
+        output_dir,
+    ]
+    subprocess.run(command_list, check=True, stdout=subprocess.DEVNULL)
+
+
 @tenacity
 def ppt_to_images(file: str, output_dir: str, warning: bool = False):
     assert pexists(file), f"File {file} does not exist"
@@ -143,16 +405,7 @@ def ppt_to_images(file: str, output_dir: str, warning: bool = False):
         print(f"ppt2images: {output_dir} already exists")
     os.makedirs(output_dir, exist_ok=True)
     with tempfile.TemporaryDirectory() as temp_dir:
-        command_list = [
-            "soffice",
-            "--headless",
-            "--convert-to",
-            "pdf",
-            file,
-            "--outdir",
-            temp_dir,
-        ]
-        subprocess.run(command_list, check=True, stdout=subprocess.DEVNULL)
+        office_convert(file, temp_dir, "pdf", "impress_pdf_Export")
 
         for f in os.listdir(temp_dir):
             if not f.endswith(".pdf"):
@@ -175,16 +428,9 @@ def wmf_to_images(blob: bytes, filepath: str):
     with tempfile.TemporaryDirectory() as temp_dir:
         with open(pjoin(temp_dir, f"{basename}.wmf"), "wb") as f:
             f.write(blob)
-        command_list = [
-            "soffice",
-            "--headless",
-            "--convert-to",
-            "jpg",
-            pjoin(temp_dir, f"{basename}.wmf"),
-            "--outdir",
-            dirname,
-        ]
-        subprocess.run(command_list, check=True, stdout=subprocess.DEVNULL)
+        office_convert(
+            pjoin(temp_dir, f"{basename}.wmf"), dirname, "jpg", "draw_jpg_Export"
+        )
 
     assert pexists(filepath), f"File {filepath} does not exist"
 
@@ -247,25 +493,38 @@ def is_primitive(obj):
 
 
 DEFAULT_EXCLUDE = set(["element", "language_id", "ln", "placeholder_format"])
+ATTR_SCHEMAS: dict[type, list[str]] = {}
+
+
+def get_attr_schema(obj) -> list[str]:
+    obj_type = type(obj)
+    if obj_type not in ATTR_SCHEMAS:
+        ATTR_SCHEMAS[obj_type] = [
+            attr
+            for attr in dir(obj)
+            if not attr.startswith("_") and not callable(getattr(obj_type, attr, None))
+        ]
+    return ATTR_SCHEMAS[obj_type]
 
 
 def object_to_dict(obj, result=None, exclude=None):
     if result is None:
         result = {}
     exclude = DEFAULT_EXCLUDE.union(exclude or set())
-    for attr in dir(obj):
+    for attr in get_attr_schema(obj):
         if attr in exclude:
             continue
         try:
-            if not attr.startswith("_") and not callable(getattr(obj, attr)):
-                attr_value = getattr(obj, attr)
-                if "real" in dir(attr_value):
-                    attr_value = attr_value.real
-                if attr == "size" and isinstance(attr_value, int):
-                    attr_value = Length(attr_value).pt
-
-                if is_primitive(attr_value):
-                    result[attr] = attr_value
+            attr_value = getattr(obj, attr)
+            if attr.startswith("_") or callable(attr_value):
+                continue
+            if hasattr(type(attr_value), "real"):
+                attr_value = attr_value.real
+            if attr == "size" and isinstance(attr_value, int):
+                attr_value = Length(attr_value).pt
+
+            if is_primitive(attr_value):
+                result[attr] = attr_value
         except:
             pass
     return result